@@ -1,6 +1,12 @@
 import numpy as np
 
 class Ball:
+    # Each ball gets the next id, which stays with it even if the simulation reorders its list of balls
+    next_id = 0
+
+    # Goes up whenever the mass, charge or radius of any ball is set, so the simulation knows to copy them again
+    properties_version = 0
+
     def __init__(self,
                  position = [0.0, 0.0],
                  velocity = [0.0, 0.0],
@@ -32,9 +38,48 @@ class Ball:
 
         # Name of ball, if desired
         self.name = name
+
+        # Number that identifies the ball
+        self.id = Ball.next_id
+        Ball.next_id += 1
+
+        # Sleeping balls are skipped until something touches them
+        self.asleep = False
         
         return
 
+    # The mass, charge and radius are properties, so that setting them updates the version
+
+    @property
+    def mass(self):
+        return self._mass
+
+    @mass.setter
+    def mass(self, value):
+        self._mass = value
+        Ball.properties_version += 1
+        return
+
+    @property
+    def charge(self):
+        return self._charge
+
+    @charge.setter
+    def charge(self, value):
+        self._charge = value
+        Ball.properties_version += 1
+        return
+
+    @property
+    def radius(self):
+        return self._radius
+
+    @radius.setter
+    def radius(self, value):
+        self._radius = value
+        Ball.properties_version += 1
+        return
+
     def distance(self, other_ball):
         return np.linalg.norm(self.position - other_ball.position)
     
@@ -8,33 +8,54 @@ class Plane:
                  normal):
         self.origin = np.array(origin)
         self.normal = np.array(normal)
+        self.offset = np.dot(self.origin, self.normal)
         return
 
-    def intersection(self, position, direction):
-        k0 = self.origin - position
-        l0 = np.dot(k0, self.normal)
+    def intersection_distance(self, position, direction):
+        """Distance along the direction to the plane, or infinity if there is no intersection; doesn't make any arrays"""
         l1 = np.dot(direction, self.normal)
-        
         if l1 < 1.0e-20:
-            # Ball is parallel to plane
-            return False, np.inf, self.origin
-        
-        # Get the distance to intersection
-        s = l0 / l1
-
+            return np.inf
+        s = (self.offset - np.dot(position, self.normal)) / l1
         if s < 0:
-            # Ball would only hit plane if it went backwards
-            return False, s, self.origin
+            return np.inf
+        return s
 
-        # Get position of intersection
-        x = position + direction * s
-        
-        return True, s, x
-    
-    def reflected_direction(self, position, direction):
-        return direction - 2 * np.dot(direction, self.normal) * self.normal
+    def reflected_direction(self, position, direction, out = None):
+        """Direction after bouncing off the plane, written into out if it is given"""
+        normal_direction = np.dot(direction, self.normal)
+        if out is None:
+            return direction - 2 * normal_direction * self.normal
+        out -= 2 * normal_direction * self.normal
+        return out
+
+class Boundary:
+    """Moving balls through walls that they bounce off of, shared by Box and Polygon, which find the next wall with partial_update"""
+
+    def update_position(self, x, dx, radius, momentum = 0.0):
+        """Update to new position, including possibly multiple boundary collisions"""
+        distance = np.sqrt(np.dot(dx, dx))
+        direction = self.direction
+        if distance == 0.0:
+            # Not moving, like a ball that has just woken up, so no direction either
+            direction.fill(0.0)
+            return x, direction
+        np.divide(dx, distance, out=direction)
+        checksum = 0
+        while distance > 0.0:
+            x, direction, distance = self.partial_update(x, direction, distance, radius, momentum)
+            checksum += 1
+            if checksum > 1000:
+                raise ValueError("Too many boundary iterations! Your balls are moving too quickly.")
+        return x, direction
+
+    def bounce(self, wall, plane, position, direction, momentum):
+        """Reflect the direction off a plane in place, which pushes on the wall with twice the normal momentum"""
+        self.wall_impulse[wall] += 2 * momentum * np.dot(direction, plane.normal)
+        plane.reflected_direction(position, direction, out=direction)
+        return
 
-class Box:
+class Box(Boundary):
     """A box with four reflecting or periodic boundaries"""
 
     def __init__(self, left, right, bottom, top, reflect=True):
@@ -52,10 +73,38 @@ class Box:
         for d in range(2):
             self.offsets[d][d] = self.upper[d].origin[d] - self.lower[d].origin[d]
             self.offsets[d+2][d] = -self.offsets[d][d]
+
+        # Direction of the ball being updated, reused to avoid making new arrays
+        self.direction = np.zeros(2)
+
+        # Momentum given to each wall by balls bouncing off of it
+        self.wall_impulse = np.zeros(4)
         return
 
     def limits(self, d):
         return [self.lower[d].origin[d], self.upper[d].origin[d]]
+
+    def lines(self):
+        """Start and end points of the walls for plotting"""
+        left, right = self.limits(0)
+        bottom, top = self.limits(1)
+        corners = [[left, bottom], [right, bottom], [right, top], [left, top]]
+        return [[corners[i], corners[(i + 1) % 4]] for i in range(4)]
+
+    def wall_lengths(self):
+        """Length of each wall, in the same order as the boundaries"""
+        width = np.diff(self.limits(0))[0]
+        height = np.diff(self.limits(1))[0]
+        return np.array([height, width, height, width])
+
+    def wall_distances(self, positions, max_distances = None):
+        """Distance from each position to the closest wall, or infinity if the walls are periodic; max_distances is only used by Polygon"""
+        distances = np.full(len(positions), np.inf)
+        if self.reflect:
+            for d in range(2):
+                np.minimum(distances, positions[:, d] - self.lower[d].origin[d], out=distances)
+                np.minimum(distances, self.upper[d].origin[d] - positions[:, d], out=distances)
+        return distances
     
     def check_inside(self, balls):
         """Make sure all the balls start inside the box"""
@@ -65,21 +114,19 @@ class Box:
                     raise ValueError("Ball is outside of the box!")
         return
     
-    def partial_update(self, position, direction, distance, radius):
+    def partial_update(self, position, direction, distance, radius, momentum = 0.0):
         """Update through a single intersection"""
-        # Get all the possible intersection events
-        events = [b.intersection(position, direction) for b in self.boundaries]
-        
-        # Find which event happens first
+        # Find which intersection event happens first
         min_event = -1
         min_dist = np.inf
-        for i, e in enumerate(events):
-            if e[0]:
+        for i, b in enumerate(self.boundaries):
+            s = b.intersection_distance(position, direction)
+            if s < np.inf:
                 # We have an intersection in the future
                 if self.reflect:
-                    actual_dist = e[1] - radius / np.abs(np.dot(self.boundaries[i].normal, direction))
+                    actual_dist = s - radius / np.abs(np.dot(b.normal, direction))
                 else:
-                    actual_dist = e[1]
+                    actual_dist = s
                 if actual_dist < min_dist:
                     min_event = i
                     min_dist = actual_dist
@@ -95,7 +142,6 @@ class Box:
             return position, direction, distance
         
         # We intersect and want to apply a reflection
-        event = events[min_event]
         boundary = self.boundaries[min_event]
         if min_dist < -0.25 * radius:
             raise ValueError("Collision distance negative: is a ball inside the wall?")
@@ -105,21 +151,222 @@ class Box:
         distance -= min_dist
         if self.reflect:
             # Reflecting boundary condition
-            direction = boundary.reflected_direction(position, direction)
+            self.bounce(min_event, boundary, position, direction, momentum)
         else:
             # Periodic boundary condition
             position += self.offsets[min_event]
             
         return position, direction, distance
+
+class Segment(Plane):
+    """A piece of a plane in 2D between two points"""
+    
+    def __init__(self,
+                 start,
+                 end,
+                 normal):
+        super().__init__(start, normal)
+        self.end = np.array(end)
+        self.length = np.linalg.norm(self.end - self.origin)
+        self.tangent = (self.end - self.origin) / self.length
+        self.tangent_offset = np.dot(self.origin, self.tangent)
+        return
+
+    def contains_along(self, position, direction, s):
+        """Check whether the point s along the direction from the position is within the segment, measured along the segment"""
+        t = np.dot(position, self.tangent) + s * np.dot(direction, self.tangent) - self.tangent_offset
+        return 0.0 <= t <= self.length
+
+    def corner_intersection_distance(self, position, direction, radius):
+        """Distance along the direction until a ball of this radius touches the start of the segment, or infinity if it doesn't"""
+        # Solve |position + s * direction - start|^2 = radius^2 for the first s
+        offset = position - self.origin
+        b = np.dot(offset, direction)
+        if b >= 0.0:
+            # Moving away from the corner
+            return np.inf
+        discriminant = b * b - np.dot(offset, offset) + radius * radius
+        if discriminant < 0.0:
+            return np.inf
+        return max(-b - np.sqrt(discriminant), 0.0)
+
+    def distance(self, point):
+        """Distance from a point to the closest part of the segment"""
+        t = np.clip(np.dot(point - self.origin, self.tangent), 0.0, self.length)
+        return np.linalg.norm(point - self.origin - t * self.tangent)
+
+class Polygon(Boundary):
+    """A closed polygon with reflecting walls, optionally with polygonal obstacles inside"""
+
+    def __init__(self, vertices, obstacles = [], cell_size = None):
+        # Walls of the container face out and walls of the obstacles face into the obstacles
+        self.vertices = self.counterclockwise(vertices)
+        self.obstacles = [self.counterclockwise(o) for o in obstacles]
+        self.walls = self.make_walls(self.vertices, 1.0)
+        self.direction = np.zeros(2)
+        self.reflect = True
+        for o in self.obstacles:
+            self.walls += self.make_walls(o, -1.0)
+        self.lower = np.amin(self.vertices, axis=0)
+        self.upper = np.amax(self.vertices, axis=0)
+
+        # Momentum given to each wall by balls bouncing off of it
+        self.wall_impulse = np.zeros(len(self.walls))
+
+        # The walls as arrays, for measuring the distance to many walls at once
+        self.origins = np.array([w.origin for w in self.walls])
+        self.tangents = np.array([w.tangent for w in self.walls])
+        self.lengths = self.wall_lengths()
+
+        # Put the walls on a grid so that each ball only checks the walls near it
+        if cell_size is None:
+            cell_size = np.mean([w.length for w in self.walls])
+        self.cell_size = cell_size
+        self.num_cells = np.maximum(np.ceil((self.upper - self.lower) / cell_size).astype(int), 1)
+        self.cells = [[[] for j in range(self.num_cells[1])] for i in range(self.num_cells[0])]
+        for w, wall in enumerate(self.walls):
+            lower = self.cell_index(np.minimum(wall.origin, wall.end))
+            upper = self.cell_index(np.maximum(wall.origin, wall.end))
+            for i in range(lower[0], upper[0] + 1):
+                for j in range(lower[1], upper[1] + 1):
+                    self.cells[i][j].append(w)
+        return
+
+    def counterclockwise(self, vertices):
+        """Order the vertices counterclockwise, using the sign of the area"""
+        vertices = np.array(vertices, dtype=float)
+        x = vertices[:, 0]
+        y = vertices[:, 1]
+        area = 0.5 * np.sum(x * np.roll(y, -1) - np.roll(x, -1) * y)
+        if area < 0:
+            return vertices[::-1]
+        return vertices
+
+    def make_walls(self, vertices, orientation):
+        """Make a wall for each edge, with the normal pointing out of a counterclockwise polygon if orientation is positive"""
+        walls = []
+        for start, end in zip(vertices, np.roll(vertices, -1, axis=0)):
+            edge = end - start
+            normal = orientation * np.array([edge[1], -edge[0]]) / np.linalg.norm(edge)
+            walls.append(Segment(start, end, normal))
+        return walls
+
+    def cell_index(self, point):
+        """Get the grid cell that a point is in"""
+        index = np.floor((point - self.lower) / self.cell_size).astype(int)
+        return np.clip(index, 0, self.num_cells - 1)
+
+    def nearby_walls(self, lower, upper):
+        """Get the indices of the walls in the grid cells that overlap the box from lower to upper"""
+        lower = self.cell_index(lower)
+        upper = self.cell_index(upper)
+        nearby = set()
+        for i in range(lower[0], upper[0] + 1):
+            for j in range(lower[1], upper[1] + 1):
+                nearby.update(self.cells[i][j])
+        return nearby
+
+    def limits(self, d):
+        return [self.lower[d], self.upper[d]]
+
+    def lines(self):
+        """Start and end points of the walls for plotting"""
+        return [[w.origin, w.end] for w in self.walls]
+
+    def wall_lengths(self):
+        """Length of each wall"""
+        return np.array([w.length for w in self.walls])
+
+    def wall_distances(self, positions, max_distances = None):
+        """Distance from each position to the closest wall; if max_distances are given, only the walls in the grid cells
+        that close are checked, and positions with no wall that close get their max_distance"""
+        num_positions = len(positions)
+        if max_distances is None:
+            max_distances = np.full(num_positions, np.inf)
+
+        # Pairs of a position and a wall near it
+        position_index = []
+        wall_index = []
+        for k in range(num_positions):
+            if np.isfinite(max_distances[k]):
+                nearby = self.nearby_walls(positions[k] - max_distances[k], positions[k] + max_distances[k])
+            else:
+                nearby = range(len(self.walls))
+            position_index.extend([k] * len(nearby))
+            wall_index.extend(nearby)
+        distances = np.array(max_distances, dtype=float)
+        if not wall_index:
+            return distances
+
+        # Distance from each position to the closest point on each of its walls
+        offsets = positions[position_index] - self.origins[wall_index]
+        t = np.clip(np.einsum('pd,pd->p', offsets, self.tangents[wall_index]), 0.0, self.lengths[wall_index])
+        offsets -= t[:, np.newaxis] * self.tangents[wall_index]
+        np.minimum.at(distances, position_index, np.sqrt(np.einsum('pd,pd->p', offsets, offsets)))
+        return distances
+
+    def point_inside(self, point, vertices):
+        """Check whether a point is inside a polygon by counting crossings of a ray in the x direction"""
+        inside = False
+        for start, end in zip(vertices, np.roll(vertices, -1, axis=0)):
+            if (start[1] > point[1]) != (end[1] > point[1]):
+                x = start[0] + (point[1] - start[1]) * (end[0] - start[0]) / (end[1] - start[1])
+                if point[0] < x:
+                    inside = not inside
+        return inside
+    
+    def check_inside(self, balls):
+        """Make sure all the balls start inside the polygon and outside the obstacles"""
+        for b in balls:
+            if not self.point_inside(b.position, self.vertices) or any(self.point_inside(b.position, o) for o in self.obstacles):
+                raise ValueError("Ball is outside of the polygon!")
+            if any(w.distance(b.position) < b.radius for w in self.walls):
+                raise ValueError("Ball is overlapping a wall!")
+        return
+
+    def partial_update(self, position, direction, distance, radius, momentum = 0.0):
+        """Update through a single intersection"""
+        # Only check the walls near the path of the ball
+        end = position + distance * direction
+        nearby = self.nearby_walls(np.minimum(position, end) - radius,
+                                   np.maximum(position, end) + radius)
         
-    def update_position(self, x, dx, radius):
-        """Update to new position, including possibly multiple boundary collisions"""
-        distance = np.linalg.norm(dx)
-        direction = dx / distance
-        checksum = 0
-        while distance > 0.0:
-            x, direction, distance = self.partial_update(x, direction, distance, radius)
-            checksum += 1
-            if checksum > 1000:
-                raise ValueError("Too many boundary iterations! Your balls are moving too quickly.")
-        return x, direction
+        # Find which wall the ball hits first
+        min_wall = -1
+        min_dist = np.inf
+        for w in nearby:
+            wall = self.walls[w]
+            s = wall.intersection_distance(position, direction)
+            if s == np.inf:
+                continue
+            
+            # Distance to where the edge of the ball touches the plane of the wall
+            actual_dist = max(s - radius / np.abs(np.dot(wall.normal, direction)), 0.0)
+            if actual_dist < min_dist and wall.contains_along(position, direction, actual_dist):
+                min_wall = w
+                min_dist = actual_dist
+                min_plane = wall
+
+        # Balls can also hit the corners, like the corner of an obstacle; each corner is the start of one wall
+        for w in nearby:
+            wall = self.walls[w]
+            s = wall.corner_intersection_distance(position, direction, radius)
+            if s < min_dist:
+                min_wall = w
+                min_dist = s
+
+                # The ball bounces off the corner as if there were a wall across the line from its center to the corner
+                normal = wall.origin - (position + s * direction)
+                min_plane = Plane(wall.origin, normal / np.linalg.norm(normal))
+
+        # Intersection happens after the prescribed distance, or not at all
+        if distance < min_dist:
+            position += distance * direction
+            distance = 0.0
+            return position, direction, distance
+
+        # We have a real collision!
+        position += min_dist * direction
+        distance -= min_dist
+        self.bounce(min_wall, min_plane, position, direction, momentum)
+        return position, direction, distance
@@ -0,0 +1,334 @@
+from BlackHoleExercise import BlackHoleGravity
+from Boundary import Box, Polygon
+from Physics import BallBallPhysics, BallEnvironmentPhysics, Charge, Collision, ConstantAcceleration, Drag, Gravity
+from Scenarios import scenarios, make_simulation
+from Sleeping import Sleeping
+
+import numpy as np
+import sys
+import time
+
+# Checks that the optimized code paths give the same forces, trajectories and conserved quantities
+# as the simple per-pair and per-ball reference code, for each scenario. Run with
+#   python3 Equivalence.py
+# which exits with an error if anything is outside of its tolerance.
+
+# Number of steps and relative tolerance for each scenario. The collision scenarios are chaotic,
+# so round-off grows quickly and they are only run for a short time.
+# The black hole eats four stars by step 800 (at steps 432, 438, 636 and 711 with seed 0), which checks
+# deleting balls and resizing the workspace. Close passes by the black hole make it chaotic too: the forces
+# agree to 3e-16, but moving each star of the reference run by one part in 1e16 already changes its
+# velocities by 2e-9 at step 800, and the different order of the sums in the faster code gives 3e-8.
+tolerances = {"BouncyBalls": (300, 1.0e-8),
+              "BouncyStars": (100, 1.0e-8),
+              "BlackHole": (800, 1.0e-6),
+              "MagneticRotation": (200, 1.0e-8),
+              "SolarSystem": (1000, 1.0e-9),
+              "Tatooine": (1000, 1.0e-8)}
+
+def use_defaults(simulation):
+    return
+
+def unfused(simulation):
+    simulation.fuse_pairs = False
+    return
+
+def polygon(simulation):
+    # Replace a reflecting box with a polygon that has the same walls
+    box = simulation.box
+    if box is not None and box.reflect:
+        left, right = box.limits(0)
+        bottom, top = box.limits(1)
+        simulation.box = Polygon([[left, bottom], [right, bottom], [right, top], [left, top]])
+    return
+
+def reordered(simulation):
+    # Sort the balls along a space-filling curve often, so the comparison has to go by ball id
+    simulation.reorder_step = 10
+    return
+
+def sleeping(simulation):
+    # Let quiet balls fall asleep; no ball should be quiet enough to sleep while it is compared
+    simulation.set_sleeping(Sleeping())
+    return
+
+# Ways to set up a simulation to use the optimized code paths
+paths = {"fused": use_defaults,
+         "unfused": unfused,
+         "polygon": polygon,
+         "reordered": reordered,
+         "sleeping": sleeping}
+
+# The reference code below is a frozen copy of the original loops, so that changes to Boundary.py,
+# Physics.py and BlackHoleExercise.py are checked against code that does not change with them
+
+def reference_intersection(plane, position, direction):
+    """Distance along the direction to the plane, like the original Plane.intersection"""
+    k0 = plane.origin - position
+    l0 = np.dot(k0, plane.normal)
+    l1 = np.dot(direction, plane.normal)
+    if l1 < 1.0e-20:
+        # Ball is parallel to plane
+        return False, np.inf, plane.origin
+    s = l0 / l1
+    if s < 0:
+        # Ball would only hit plane if it went backwards
+        return False, s, plane.origin
+    return True, s, position + direction * s
+
+def reference_reflected_direction(plane, position, direction):
+    return direction - 2 * np.dot(direction, plane.normal) * plane.normal
+
+def reference_partial_update(box, position, direction, distance, radius):
+    """Update through a single intersection, like the original Box.partial_update"""
+    events = [reference_intersection(b, position, direction) for b in box.boundaries]
+
+    # Find which event happens first
+    min_event = -1
+    min_dist = np.inf
+    for i, e in enumerate(events):
+        if e[0]:
+            if box.reflect:
+                actual_dist = e[1] - radius / np.abs(np.dot(box.boundaries[i].normal, direction))
+            else:
+                actual_dist = e[1]
+            if actual_dist < min_dist:
+                min_event = i
+                min_dist = actual_dist
+    if min_event < 0:
+        raise ValueError("No intersection found: is a ball outside the box?")
+
+    # Intersection happens after the prescribed distance
+    if distance < min_dist:
+        position += distance * direction
+        return position, direction, 0.0
+    if min_dist < -0.25 * radius:
+        raise ValueError("Collision distance negative: is a ball inside the wall?")
+
+    # We have a real collision
+    position += min_dist * direction
+    distance -= min_dist
+    if box.reflect:
+        direction = reference_reflected_direction(box.boundaries[min_event], position, direction)
+    else:
+        position += box.offsets[min_event]
+    return position, direction, distance
+
+def reference_update_position(box, x, dx, radius):
+    """Move through any number of boundary collisions, like the original Box.update_position"""
+    distance = np.linalg.norm(dx)
+    direction = dx / distance
+    checksum = 0
+    while distance > 0.0:
+        x, direction, distance = reference_partial_update(box, x, direction, distance, radius)
+        checksum += 1
+        if checksum > 1000:
+            raise ValueError("Too many boundary iterations! Your balls are moving too quickly.")
+    return x, direction
+
+def reference_pre_step_update(p, balls, time_step):
+    """Spring constant and black hole captures like the original pre_step_update, otherwise the physics' own"""
+    if isinstance(p, Collision):
+        if p.evolve_spring_constant:
+            velocities = np.array([np.linalg.norm(b.velocity) for b in balls])
+            masses = np.array([b.mass for b in balls])
+            radii = np.array([b.radius for b in balls])
+            constants = velocities * masses / (radii * time_step)
+            p.spring_constant = np.mean(constants)
+        return
+    if isinstance(p, BlackHoleGravity):
+        black_hole = p.black_hole
+        deleteme = list()
+        for i, b in enumerate(balls):
+            if b is black_hole:
+                continue
+            dist = black_hole.distance(b)
+            escape_velocity = np.sqrt(2 * p.G * black_hole.mass / dist)
+            if dist < black_hole.radius:
+                black_hole.velocity = (black_hole.mass * black_hole.velocity + b.mass * b.velocity) / (black_hole.mass + b.mass)
+                black_hole.mass += b.mass
+                black_hole.radius = np.power(b.radius ** 3 + black_hole.radius ** 3, 1.0/3.0)
+                deleteme.append(i)
+            elif np.linalg.norm(b.velocity) > escape_velocity and dist > 50 * black_hole.radius:
+                deleteme.append(i)
+        for i in sorted(deleteme, reverse = True):
+            del balls[i]
+        return
+    p.pre_step_update(balls, time_step)
+    return
+
+def reference_forces(balls, physics):
+    """Forces from force_bb for each pair and force_be for each ball, like the original loops"""
+    forces = np.zeros((len(balls), 2))
+    for p in physics:
+        if isinstance(p, BallBallPhysics):
+            for i in range(len(balls)):
+                for j in range(i+1, len(balls)):
+                    forceij = p.force_bb(balls[i], balls[j])
+                    forces[i] += forceij
+                    forces[j] -= forceij
+        elif isinstance(p, BallEnvironmentPhysics):
+            for i, b in enumerate(balls):
+                forces[i] += p.force_be(b)
+        else:
+            p.add_force(balls, forces)
+    return forces
+
+def reference_step(simulation):
+    """Take one step with the reference forces and a per-ball Euler update"""
+    balls = simulation.balls
+    dt = simulation.time_step
+    for p in simulation.physics:
+        reference_pre_step_update(p, balls, dt)
+    forces = reference_forces(balls, simulation.physics)
+    for i, b in enumerate(balls):
+        b.velocity = b.velocity + dt * forces[i] / b.mass
+        dx = dt * b.velocity
+        if isinstance(simulation.box, Box):
+            speed = np.linalg.norm(b.velocity)
+            b.position, direction = reference_update_position(simulation.box, b.position, dx, b.radius)
+            b.velocity = direction * speed
+        elif simulation.box is not None:
+            speed = np.linalg.norm(b.velocity)
+            b.position, direction = simulation.box.update_position(b.position, dx, b.radius)
+            b.velocity = direction * speed
+        else:
+            b.position = b.position + dx
+    simulation.time += dt
+    simulation.step_count += 1
+    simulation.update_kinetic_energy()
+    return
+
+def total_energy(simulation):
+    """Kinetic energy plus the potential energy from the conservative physics"""
+    balls = simulation.balls
+    energy = sum(0.5 * b.mass * np.dot(b.velocity, b.velocity) for b in balls)
+    for p in simulation.physics:
+        for i in range(len(balls)):
+            if isinstance(p, ConstantAcceleration):
+                energy -= balls[i].mass * np.dot(p.acceleration, balls[i].position)
+            for j in range(i+1, len(balls)):
+                dist = balls[i].distance(balls[j])
+                if isinstance(p, Gravity):
+                    energy -= p.G * balls[i].mass * balls[j].mass / dist
+                elif isinstance(p, Charge):
+                    energy += p.k * balls[i].charge * balls[j].charge / dist
+                elif isinstance(p, Collision):
+                    overlap = balls[i].radius + balls[j].radius - dist
+                    if overlap > 0:
+                        energy += 0.5 * p.spring_constant * overlap ** 2
+    return energy
+
+def total_momentum(simulation):
+    return sum(b.mass * b.velocity for b in simulation.balls)
+
+def relative_difference(a, b):
+    """Largest difference relative to the largest value"""
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    scale = max(np.amax(np.abs(a)), np.amax(np.abs(b)), 1.0e-300)
+    return np.amax(np.abs(a - b)) / scale
+
+def ball_state(simulation, attribute):
+    """Attribute of each ball, in the order the balls were made"""
+    return np.array([getattr(b, attribute) for b in sorted(simulation.balls, key=lambda b: b.id)])
+
+def check(name, path, seed = 0):
+    """Compare one optimized path against the reference for one scenario; returns the worst relative differences"""
+    num_steps, tolerance = tolerances[name]
+    setup = paths[path]
+    results = {}
+
+    # Forces after the first pre-step update, each with its own code
+    reference = make_simulation(name, seed)
+    for p in reference.physics:
+        reference_pre_step_update(p, reference.balls, reference.time_step)
+    optimized = make_simulation(name, seed)
+    setup(optimized)
+    for p in optimized.physics:
+        p.pre_step_update(optimized.balls, optimized.time_step)
+    results["forces"] = relative_difference(reference_forces(reference.balls, reference.physics), optimized.calculate_forces())
+
+    # Trajectories
+    reference = make_simulation(name, seed)
+    optimized = make_simulation(name, seed)
+    setup(optimized)
+    energy = [total_energy(reference), total_energy(optimized)]
+    momentum = [total_momentum(reference), total_momentum(optimized)]
+    for s in range(num_steps):
+        reference_step(reference)
+        optimized.step()
+    if len(reference.balls) != len(optimized.balls):
+        results["balls"] = np.inf
+    else:
+        results["positions"] = relative_difference(ball_state(reference, "position"), ball_state(optimized, "position"))
+        results["velocities"] = relative_difference(ball_state(reference, "velocity"), ball_state(optimized, "velocity"))
+
+        # Change in the conserved quantities, compared between the two runs
+        results["energy"] = abs((total_energy(reference) - energy[0]) - (total_energy(optimized) - energy[1])) / max(abs(energy[0]), 1.0e-300)
+        momentum_scale = max(sum(np.linalg.norm(b.mass * b.velocity) for b in reference.balls), 1.0e-300)
+        results["momentum"] = np.linalg.norm((total_momentum(reference) - momentum[0]) - (total_momentum(optimized) - momentum[1])) / momentum_scale
+    return results, tolerance
+
+def check_all(names = None, path_names = None, seed = 0):
+    """Check every scenario with every optimized path, printing a table; returns whether everything passed"""
+    names = list(scenarios) if names is None else names
+    path_names = list(paths) if path_names is None else path_names
+    passed = True
+    print("{:>17} {:>9} {:>10} {:>10}   {}".format("scenario", "path", "tolerance", "worst", "result"))
+    for name in names:
+        for path in path_names:
+            results, tolerance = check(name, path, seed)
+            worst_key = max(results, key=results.get)
+            ok = results[worst_key] <= tolerance
+            passed = passed and ok
+            print("{:>17} {:>9} {:10.1e} {:10.1e}   {}".format(name, path, tolerance, results[worst_key],
+                                                              "pass" if ok else "FAIL ({})".format(worst_key)))
+    return passed
+
+def settled_pile(sleeping, num_balls = 60, seed = 0):
+    """Bouncy balls with drag and stiff springs, which settle into a pile at the bottom of the box"""
+    simulation = make_simulation("BouncyBalls", seed, num_balls = num_balls)
+    simulation.physics[0].evolve_spring_constant = False
+    simulation.physics.append(Drag(linear = 5.0, quadratic = 0.0))
+    simulation.physics[-1].set_simulation(simulation)
+    if sleeping:
+        simulation.set_sleeping(Sleeping())
+    return simulation
+
+def check_sleeping(compare_steps = 150, tolerance = 1.0e-8, settle_steps = 8000, timed_steps = 1000, min_asleep = 0.9):
+    """Compare a falling pile with sleeping against the reference, then check that it falls asleep once it settles and print how long a step takes with and without sleeping; returns whether everything passed"""
+    # The balls are still falling, so none of them should sleep and the trajectories should match the reference.
+    # The pile is chaotic once the balls touch: round-off grows by about ten times every 25 steps
+    reference = settled_pile(False)
+    optimized = settled_pile(True)
+    for s in range(compare_steps):
+        reference_step(reference)
+        optimized.step()
+    worst = max(relative_difference(ball_state(reference, "position"), ball_state(optimized, "position")),
+                relative_difference(ball_state(reference, "velocity"), ball_state(optimized, "velocity")))
+    passed = worst <= tolerance
+    print("{:>17} {:>9} {:10.1e} {:10.1e}   {}".format("pile", "falling", tolerance, worst, "pass" if passed else "FAIL (trajectory)"))
+
+    print("{:>17} {:>9} {:>10}".format("pile", "asleep", "ms/step"))
+    for sleeping in [False, True]:
+        simulation = settled_pile(sleeping)
+        for s in range(settle_steps):
+            simulation.step()
+        timer = time.perf_counter()
+        for s in range(timed_steps):
+            simulation.step()
+        elapsed = (time.perf_counter() - timer) / timed_steps
+        asleep = np.mean([b.asleep for b in simulation.balls])
+        if not sleeping:
+            print("{:>17} {:9.0%} {:10.3f}".format("awake", asleep, 1000 * elapsed))
+            continue
+        ok = asleep >= min_asleep
+        passed = passed and ok
+        print("{:>17} {:9.0%} {:10.3f}   {}".format("sleeping", asleep, 1000 * elapsed, "pass" if ok else "FAIL (asleep)"))
+    return passed
+
+if __name__ == "__main__":
+    passed = check_all()
+    passed = check_sleeping() and passed
+    sys.exit(0 if passed else 1)
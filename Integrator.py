@@ -0,0 +1,431 @@
+from Ball import Ball
+from Physics import Collision, Gravity
+
+import numpy as np
+import operator
+import warnings
+
+def stumpff(z):
+    """Stumpff functions C(z) and S(z), https://en.wikipedia.org/wiki/Stumpff_function"""
+    c = np.empty_like(z)
+    s = np.empty_like(z)
+
+    # Use the series near zero, where the closed forms lose precision
+    small = np.abs(z) < 1.0e-3
+    zs = z[small]
+    c[small] = 1.0 / 2.0 - zs / 24.0 + zs ** 2 / 720.0 - zs ** 3 / 40320.0
+    s[small] = 1.0 / 6.0 - zs / 120.0 + zs ** 2 / 5040.0 - zs ** 3 / 362880.0
+
+    # Elliptic orbits
+    positive = ~small & (z > 0)
+    sz = np.sqrt(z[positive])
+    c[positive] = (1.0 - np.cos(sz)) / z[positive]
+    s[positive] = (sz - np.sin(sz)) / sz ** 3
+
+    # Hyperbolic orbits
+    negative = ~small & (z < 0)
+    sz = np.sqrt(-z[negative])
+    c[negative] = (np.cosh(sz) - 1.0) / -z[negative]
+    s[negative] = (np.sinh(sz) - sz) / sz ** 3
+    return c, s
+
+def kepler_drift(mu, positions, velocities, dt, tolerance = 1.0e-13, max_iterations = 50):
+    """Move each body along its Kepler orbit around a fixed mass with gravitational parameter mu for a time dt, using universal variables"""
+    # https://en.wikipedia.org/wiki/Universal_variable_formulation
+    r0 = np.sqrt(np.einsum('bd,bd->b', positions, positions))
+    v02 = np.einsum('bd,bd->b', velocities, velocities)
+    rv0 = np.einsum('bd,bd->b', positions, velocities)
+    sqrt_mu = np.sqrt(mu)
+
+    # Reciprocal of the semi-major axis, which is negative for hyperbolic orbits
+    alpha = 2.0 / r0 - v02 / mu
+
+    # Solve the universal Kepler equation for chi with Newton's method
+    chi = sqrt_mu * np.abs(alpha) * dt
+    chi = np.where(alpha > 0, chi, sqrt_mu * dt / r0)
+    for iteration in range(max_iterations):
+        z = alpha * chi ** 2
+        c, s = stumpff(z)
+        f = rv0 / sqrt_mu * chi ** 2 * c + (1.0 - alpha * r0) * chi ** 3 * s + r0 * chi - sqrt_mu * dt
+        df = rv0 / sqrt_mu * chi * (1.0 - z * s) + (1.0 - alpha * r0) * chi ** 2 * c + r0
+        delta = f / df
+        chi -= delta
+        if np.all(np.abs(delta) <= tolerance * np.maximum(np.abs(chi), 1.0e-300)):
+            break
+    else:
+        raise ValueError("Kepler equation did not converge: is the time step too large?")
+
+    # Lagrange coefficients, https://en.wikipedia.org/wiki/Orbital_state_vectors
+    z = alpha * chi ** 2
+    c, s = stumpff(z)
+    f = 1.0 - chi ** 2 / r0 * c
+    g = dt - chi ** 3 / sqrt_mu * s
+    new_positions = f[:, np.newaxis] * positions + g[:, np.newaxis] * velocities
+    r = np.sqrt(np.einsum('bd,bd->b', new_positions, new_positions))
+    fdot = sqrt_mu / (r * r0) * (z * s - 1.0) * chi
+    gdot = 1.0 - chi ** 2 / r * c
+    new_velocities = fdot[:, np.newaxis] * positions + gdot[:, np.newaxis] * velocities
+    return new_positions, new_velocities
+
+class WisdomHolman:
+    """Wisdom-Holman integrator for systems where one ball, the primary, is much heavier than the rest, like the sun or a black hole"""
+
+    # Each step drifts everything along its Kepler orbit around the primary for half a step,
+    # kicks the velocities with every other force for a full step, then drifts for another half step.
+    # This uses democratic heliocentric coordinates, https://doi.org/10.1086/300541
+
+    def __init__(self, primary):
+        self.primary = primary
+        return
+
+    def find_gravity(self, simulation):
+        for p in simulation.physics:
+            if isinstance(p, Gravity):
+                return p
+        raise ValueError("WisdomHolman needs a Gravity package in the physics")
+
+    def step(self, simulation):
+        """Take one step of simulation.time_step"""
+        if simulation.box is not None:
+            raise ValueError("WisdomHolman doesn't work with a box")
+        dt = simulation.time_step
+        gravity = self.find_gravity(simulation)
+        balls = simulation.balls
+        others = [b for b in balls if b is not self.primary]
+        if len(others) == len(balls):
+            raise ValueError("WisdomHolman primary is not one of the balls")
+        mu = gravity.G * self.primary.mass
+
+        # Heliocentric positions and barycentric velocities
+        masses = np.array([b.mass for b in others])
+        total_mass = self.primary.mass + np.sum(masses)
+        positions = np.array([b.position for b in others], dtype=float)
+        velocities = np.array([b.velocity for b in others], dtype=float)
+        center_position = (self.primary.mass * self.primary.position + masses @ positions) / total_mass
+        center_velocity = (self.primary.mass * self.primary.velocity + masses @ velocities) / total_mass
+        positions -= self.primary.position
+        velocities -= center_velocity
+
+        # Drift, kick, drift
+        positions, velocities = self.drift(mu, masses, positions, velocities, 0.5 * dt)
+        center_position = center_position + 0.5 * dt * center_velocity
+        self.set_balls(simulation, others, masses, total_mass, center_position, center_velocity, positions, velocities)
+        velocities += dt * self.interaction_accelerations(simulation, gravity, others, masses, positions)
+        positions, velocities = self.drift(mu, masses, positions, velocities, 0.5 * dt)
+        center_position = center_position + 0.5 * dt * center_velocity
+        self.set_balls(simulation, others, masses, total_mass, center_position, center_velocity, positions, velocities)
+        return
+
+    def drift(self, mu, masses, positions, velocities, dt):
+        """Move the primary by the total momentum of the others, then move the others along their Kepler orbits"""
+        positions = positions + 0.5 * dt * (masses @ velocities) / self.primary.mass
+        positions, velocities = kepler_drift(mu, positions, velocities, dt)
+        positions += 0.5 * dt * (masses @ velocities) / self.primary.mass
+        return positions, velocities
+
+    def interaction_accelerations(self, simulation, gravity, others, masses, positions):
+        """Accelerations from all the physics, except for the gravity of the primary, which is in the Kepler orbits"""
+        forces = simulation.calculate_forces()
+        index = {id(b): i for i, b in enumerate(simulation.balls)}
+        accelerations = np.array([forces[index[id(b)]] for b in others]) / masses[:, np.newaxis]
+        r3 = np.einsum('bd,bd->b', positions, positions) ** 1.5
+        accelerations += gravity.G * self.primary.mass * positions / r3[:, np.newaxis]
+        return accelerations
+
+    def set_balls(self, simulation, others, masses, total_mass, center_position, center_velocity, positions, velocities):
+        """Convert back to positions and velocities in the simulation's frame and put them in the balls"""
+        primary_position = center_position - (masses @ positions) / total_mass
+        self.primary.position[:] = primary_position
+        self.primary.velocity[:] = center_velocity - (masses @ velocities) / self.primary.mass
+        for k, b in enumerate(others):
+            b.position[:] = positions[k] + primary_position
+            b.velocity[:] = velocities[k] + center_velocity
+        simulation.positions_changed()
+        return
+
+class AdaptiveTimeStep:
+    """Chooses the time step from an error estimate and limits on how far the balls move, and takes a step again with a smaller time step if the error is too big"""
+
+    # Each step is a velocity Verlet step, https://en.wikipedia.org/wiki/Verlet_integration#Velocity_Verlet,
+    # which needs the forces at the end of the step. Its velocity update is the trapezoid rule, which is off by
+    # dt^3 / 12 times the rate of change of the jerk, estimated from the jerks over this step and the last one.
+    # The error goes down like dt^3, which sets the next time step. The first step doesn't have a last step,
+    # so it uses how far the default update would have been off, dt / 2 times the change in acceleration.
+    # Collisions turn on and off too quickly for that, so balls that are touching get a looser tolerance,
+    # and the step is kept to a fraction of the time that balls stay touching.
+    # The forces at the end of a step are also the forces at the start of the next one, unless something they
+    # depend on has changed, so most steps only calculate the forces once.
+
+    def __init__(self,
+                 tolerance = 1.0e-3,
+                 contact_tolerance = 0.1,
+                 courant = 0.15,
+                 min_time_step = 0.0,
+                 max_time_step = np.inf,
+                 safety = 0.9,
+                 max_growth = 1.5,
+                 max_shrink = 0.2,
+                 max_rejections = 10):
+        # Largest velocity error allowed in a step, relative to the speed of the ball plus the typical speed of the balls
+        self.tolerance = tolerance
+
+        # The same for balls that are touching, whose accelerations jump when they start and stop touching
+        self.contact_tolerance = contact_tolerance
+
+        # Fraction of its radius, or of its distance to the nearest wall, that a ball can move in one step,
+        # and fraction of the time of a collision that a step can take
+        self.courant = courant
+
+        # Limits on the time step and on how fast it can change from one step to the next
+        self.min_time_step = min_time_step
+        self.max_time_step = max_time_step
+        self.safety = safety
+        self.max_growth = max_growth
+        self.max_shrink = max_shrink
+        self.max_rejections = max_rejections
+
+        # Time step the error estimate asks for, which the limits can make smaller
+        self.next_time_step = None
+
+        # Number of steps taken and thrown away, the number of steps that had to be taken even though they were
+        # still not accurate enough after max_rejections tries or at min_time_step, and the number of times the forces were calculated
+        self.num_accepted = 0
+        self.num_rejected = 0
+        self.num_inaccurate = 0
+        self.num_force_calculations = 0
+
+        # Rate of change of the acceleration of each ball over the last step, and the balls and time step it was for
+        self.jerks = None
+        self.jerk_known = None
+        self.jerk_balls = None
+        self.last_time_step = None
+
+        # Forces at the end of the last step, and what they were calculated from
+        self.end_forces = None
+        self.end_positions = None
+        self.end_key = None
+        return
+
+    def courant_limit(self, simulation, time_step = np.inf):
+        """Largest time step up to time_step that keeps each ball from moving too far compared to its radius, for collisions, or its distance to the walls"""
+        balls = simulation.balls
+        collisions = [p for p in simulation.physics if isinstance(p, Collision)]
+        limit = time_step
+        masses = np.array([b.mass for b in balls], dtype=float)
+        for p in collisions:
+            if len(balls) == 0:
+                continue
+            # A step can only be a fraction of the time that two of the lightest balls stay touching,
+            # which is half the period of the spring with their reduced mass, pi sqrt(m / 2 k)
+            spring_constant = p.spring_constant
+            if p.evolve_spring_constant:
+                spring_constant = p.spring_impulse(balls) / p.spring_time_step
+            if spring_constant > 0.0:
+                limit = min(limit, self.courant * np.pi * np.sqrt(0.5 * np.amin(masses) / spring_constant))
+
+        velocities = np.array([b.velocity for b in balls], dtype=float).reshape(-1, 2)
+        speeds = np.sqrt(np.einsum('bd,bd->b', velocities, velocities))
+        moving = speeds > 0.0
+        if not np.any(moving):
+            return limit
+        radii = np.array([b.radius for b in balls], dtype=float)
+        if collisions:
+            # A fraction of the radius, which is never more than the limit from the walls below
+            lengths = radii
+        elif simulation.box is not None:
+            # Walls farther away than a ball can get in this time step don't limit it, so they don't need to be found
+            reach = np.full(len(balls), np.inf)
+            if np.isfinite(limit):
+                reach = speeds * limit / self.courant + radii
+            positions = np.array([b.position for b in balls], dtype=float).reshape(-1, 2)
+            gaps = simulation.box.wall_distances(positions, reach) - radii
+
+            # Balls touching the wall can still move a fraction of their radius
+            lengths = np.maximum(gaps, radii)
+        else:
+            return limit
+        return min(limit, self.courant * np.amin(lengths[moving] / speeds[moving]))
+
+    def choose_time_step(self, simulation):
+        """Set the time step for the next step from the error estimate and the limits"""
+        for p in simulation.physics:
+            if isinstance(p, Collision):
+                p.record_contacts = True
+
+                # Springs that got stiffer as the time step shrinks would push balls that are touching apart
+                # harder on each smaller step, so they keep the time step the simulation started with
+                if p.evolve_spring_constant and p.spring_time_step is None:
+                    p.spring_time_step = simulation.time_step
+        time_step = simulation.time_step if self.next_time_step is None else self.next_time_step
+        time_step = self.courant_limit(simulation, min(time_step, self.max_time_step))
+        simulation.time_step = max(time_step, self.min_time_step)
+        return
+
+    def force_key(self, simulation, awake):
+        """Everything besides the positions that the forces depend on, or None if they might depend on the velocities"""
+        if any(p.depends_on_velocity() for p in simulation.physics):
+            return None
+        return (len(simulation.balls),
+                Ball.properties_version,
+                None if awake is None else awake.tobytes(),
+                tuple(p.spring_constant for p in simulation.physics if isinstance(p, Collision)))
+
+    def start_forces(self, simulation, awake = None):
+        """Forces at the start of a step, reusing the ones from the end of the last step if nothing they depend on has changed"""
+        key = self.force_key(simulation, awake)
+        if key is None or key != self.end_key:
+            return self.calculate_forces(simulation, awake)
+        for k, b in enumerate(simulation.balls):
+            if not np.array_equal(b.position, self.end_positions[k]):
+                return self.calculate_forces(simulation, awake)
+        return self.end_forces
+
+    def save_forces(self, simulation, forces, awake):
+        """Keep the forces at the end of a step for the start of the next one"""
+        self.end_key = self.force_key(simulation, awake)
+        if self.end_key is None:
+            return
+        if self.end_forces is None or self.end_forces.shape != forces.shape:
+            self.end_forces = np.zeros(forces.shape)
+            self.end_positions = np.zeros((len(simulation.balls), 2))
+        np.copyto(self.end_forces, forces)
+        for k, b in enumerate(simulation.balls):
+            self.end_positions[k] = b.position
+        return
+
+    def calculate_forces(self, simulation, awake = None):
+        """Get the forces from the simulation, counting how many times it is done"""
+        self.num_force_calculations += 1
+        return simulation.calculate_forces(awake)
+
+    def update_spring_constants(self, simulation):
+        """Recalculate the spring constants that depend on the time step; returns whether any of them changed"""
+        updated = False
+        for p in simulation.physics:
+            if isinstance(p, Collision) and p.evolve_spring_constant:
+                spring_constant = p.spring_constant
+                p.pre_step_update(simulation.balls, simulation.time_step)
+                updated = updated or p.spring_constant != spring_constant
+        return updated
+
+    def touching(self, simulation, touching):
+        """Mark the balls that the collision packages found touching in the last force calculation"""
+        for p in simulation.physics:
+            if isinstance(p, Collision) and p.contacts is not None:
+                touching[p.contacts[0]] = True
+                touching[p.contacts[1]] = True
+        return
+
+    def error(self, time_step, jerks, last_jerks, velocities, touching):
+        """Largest velocity error of a step relative to the tolerance, so 1 is just barely accurate enough, and the power of the time step it goes like"""
+        if last_jerks is None:
+            # Without the last step, all there is to go on is the difference from the default update
+            change = time_step * jerks
+            errors = 0.5 * time_step * np.sqrt(np.einsum('bd,bd->b', change, change))
+            order = 2
+        else:
+            # The Verlet update of the velocity is the trapezoid rule, which is off by dt^3 / 12 times the change in the jerk
+            change = (jerks - last_jerks) / (0.5 * (time_step + self.last_time_step))
+            errors = time_step ** 3 / 12.0 * np.sqrt(np.einsum('bd,bd->b', change, change))
+            order = 3
+        if np.all(errors == 0.0):
+            return 0.0, order
+        speeds = np.sqrt(np.einsum('bd,bd->b', velocities, velocities))
+        scale = np.where(touching, self.contact_tolerance, self.tolerance) * (speeds + np.sqrt(np.mean(speeds ** 2)))
+        return np.amax(errors / np.maximum(scale, 1.0e-300)), order
+
+    def same_jerk_balls(self, balls):
+        """Whether the saved jerks are for these balls, in this order"""
+        return self.jerk_balls is not None and len(balls) == len(self.jerk_balls) and not any(map(operator.is_not, balls, self.jerk_balls))
+
+    def last_jerks(self, simulation, indices):
+        """Jerks of the balls over the last step, or None if some of them haven't moved in a step yet"""
+        if not self.same_jerk_balls(simulation.balls) or not np.all(self.jerk_known[indices]):
+            return None
+        return self.jerks[indices]
+
+    def save_jerks(self, simulation, indices, jerks):
+        """Keep the jerks of the balls that moved in this step for the next error estimate"""
+        balls = simulation.balls
+        if not self.same_jerk_balls(balls):
+            self.jerk_balls = list(balls)
+            self.jerks = np.zeros((len(balls), 2))
+            self.jerk_known = np.zeros(len(balls), dtype=bool)
+        self.jerks[indices] = jerks
+        self.jerk_known[indices] = True
+        self.last_time_step = simulation.time_step
+        return
+
+    def kick(self, balls, indices, accelerations, time_step):
+        """Change the velocities by the accelerations over a time step"""
+        for k, i in enumerate(indices):
+            balls[i].velocity += time_step * accelerations[k]
+        return
+
+    def step(self, simulation, forces, awake = None):
+        """Take a velocity Verlet step, throwing it away and trying a smaller time step until the error is small enough"""
+        balls = simulation.balls
+        indices = np.arange(len(balls)) if awake is None else awake
+        if len(indices) == 0:
+            return
+        masses = np.array([balls[i].mass for i in indices], dtype=float)
+        old_accelerations = forces[indices] / masses[:, np.newaxis]
+        touching = np.zeros(len(balls), dtype=bool)
+        self.touching(simulation, touching)
+        touched_before = touching.copy()
+
+        # Save what the step changes, so it can be undone
+        positions = np.array([balls[i].position for i in indices], dtype=float).reshape(-1, 2)
+        velocities = np.array([balls[i].velocity for i in indices], dtype=float).reshape(-1, 2)
+        box = simulation.box
+        wall_impulse = box.wall_impulse.copy() if box is not None else None
+        last_jerks = self.last_jerks(simulation, indices)
+
+        for attempt in range(self.max_rejections + 1):
+            dt = simulation.time_step
+
+            # Half a kick, a drift through the box, then the other half of the kick with the new forces
+            self.kick(balls, indices, old_accelerations, 0.5 * dt)
+            for i in indices:
+                simulation.update_position(balls[i])
+            new_forces = self.calculate_forces(simulation, awake)
+            new_accelerations = new_forces[indices] / masses[:, np.newaxis]
+            self.kick(balls, indices, new_accelerations, 0.5 * dt)
+
+            # Estimate the error from how fast the accelerations are changing, with a looser tolerance for the balls that were touching
+            touching[:] = touched_before
+            self.touching(simulation, touching)
+            new_velocities = np.array([balls[i].velocity for i in indices], dtype=float).reshape(-1, 2)
+            jerks = (new_accelerations - old_accelerations) / dt
+            error, order = self.error(dt, jerks, last_jerks, np.maximum(np.abs(velocities), np.abs(new_velocities)), touching[indices])
+            factor = self.max_growth if error == 0.0 else min(self.max_growth, max(self.max_shrink, self.safety * error ** (-1.0 / order)))
+            if error <= 1.0 or dt <= self.min_time_step or attempt == self.max_rejections:
+                break
+
+            # Too inaccurate: put everything back and try again with a smaller time step
+            self.num_rejected += 1
+            for k, i in enumerate(indices):
+                balls[i].position[:] = positions[k]
+                balls[i].velocity[:] = velocities[k]
+            simulation.positions_changed()
+            if box is not None:
+                box.wall_impulse[:] = wall_impulse
+            simulation.time_step = max(dt * factor, self.min_time_step)
+            if self.update_spring_constants(simulation):
+                # The springs depend on the time step, so the forces at the start of the step change too
+                forces = self.calculate_forces(simulation, awake)
+                old_accelerations = forces[indices] / masses[:, np.newaxis]
+                touched_before[:] = False
+                self.touching(simulation, touched_before)
+
+        if error > 1.0:
+            # Out of tries, so keep the step, but don't count it as accurate
+            self.num_inaccurate += 1
+            warnings.warn("AdaptiveTimeStep took a step at time {:g} with {:g} times the tolerated error; "
+                          "see num_inaccurate, and try a smaller min_time_step or more max_rejections".format(simulation.time, error))
+        else:
+            self.num_accepted += 1
+        self.next_time_step = simulation.time_step * min(factor, self.max_growth)
+        self.save_jerks(simulation, indices, jerks)
+        self.save_forces(simulation, new_forces, awake)
+        return
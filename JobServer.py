@@ -0,0 +1,367 @@
+from Ball import Ball
+from Scenarios import scenarios, make_simulation
+
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import multiprocessing
+import os
+import socket
+from time import perf_counter
+
+# A local server that runs queued simulations on a few worker processes. Start it with
+#   python3 JobServer.py --workers 4
+# and send it jobs with submit() from another script, or any program that can write JSON lines to the socket.
+#
+# Each message is one line of JSON. Jobs are submitted with
+#   {"command": "submit", "scenario": "SolarSystem", "steps": 10000, "priority": 0, ...}
+# and the server answers with the job's id, then streams progress messages to the same connection
+# until a "done", "cancelled" or "error" message, which has the outputs of the job. Other commands are
+#   {"command": "cancel", "job": id}   stop a job that is queued or running
+#   {"command": "watch", "job": id}    get the messages of a job on this connection too, or its last message
+#                                      if it has finished in the last keep_finished seconds
+#   {"command": "status"}              list the jobs and what they are doing
+#   {"command": "shutdown"}            stop the workers and the server
+
+# Keys of a job description, with their defaults
+job_defaults = {"scenario": None,     # name of a scenario in Scenarios.py
+                "arguments": {},      # keyword arguments for the scenario, like {"num_balls": 100}
+                "seed": 0,            # random seed for the scenario
+                "settings": {},       # simulation attributes to set, like {"time_step": 0.001, "reorder_step": 50}
+                "steps": None,        # stop after this many steps,
+                "time": None,         # or at this simulation time,
+                "wall_clock": None,   # or after this many seconds, whichever comes first
+                "every": 100,         # steps between progress messages
+                "priority": 0}        # jobs with lower numbers run first
+
+def check_job(description):
+    """Fill in the defaults of a job description and check that it can be run"""
+    unknown = [k for k in description if k not in job_defaults and k != "command"]
+    if unknown:
+        raise ValueError("unknown job keys: {}".format(", ".join(unknown)))
+    job = {k: description.get(k, v) for k, v in job_defaults.items()}
+    if job["scenario"] not in scenarios:
+        raise ValueError("unknown scenario {}, choose from {}".format(job["scenario"], ", ".join(scenarios)))
+    if job["steps"] is None and job["time"] is None and job["wall_clock"] is None:
+        raise ValueError("a job needs at least one of steps, time or wall_clock")
+
+    # The queue compares priorities, so a bad type would break it for every job after this one
+    for key in ["priority", "every", "seed", "steps", "time", "wall_clock"]:
+        value = job[key]
+        if value is None and key in ["steps", "time", "wall_clock"]:
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError("{} has to be a number".format(key))
+        if key in ["every", "seed", "steps"] and not isinstance(value, int):
+            raise ValueError("{} has to be a whole number".format(key))
+    for key in ["arguments", "settings"]:
+        if not isinstance(job[key], dict):
+            raise ValueError("{} has to be an object".format(key))
+    if job["every"] < 1:
+        raise ValueError("every has to be at least 1")
+    return job
+
+def run_job(job, connection, cancel):
+    """Run one job in a worker process, sending progress messages through the connection; returns the last message"""
+    start = perf_counter()
+
+    # Workers run many jobs, so number the balls from zero for each one to get the same ids for the same job
+    Ball.next_id = 0
+    simulation = make_simulation(job["scenario"], job["seed"], **job["arguments"])
+    for name, value in job["settings"].items():
+        if not hasattr(simulation, name):
+            raise ValueError("Simulation has no setting {}".format(name))
+        setattr(simulation, name, value)
+
+    # Take steps one at a time so a cancel is noticed quickly, and report every so often
+    history = []
+    last_step = 0
+    last_clock = perf_counter()
+    for state in simulation.iterate(every = 1, time = job["time"], steps = job["steps"], wall_clock = job["wall_clock"]):
+        if cancel.is_set():
+            return {"event": "cancelled", "step": state.step, "time": state.time}
+        if state.step % job["every"] == 0:
+            clock = perf_counter()
+            history.append([state.step, state.time, state.kinetic_energy])
+            connection.send({"event": "progress",
+                             "step": state.step,
+                             "time": state.time,
+                             "steps_per_second": (state.step - last_step) / max(clock - last_clock, 1.0e-9),
+                             "kinetic_energy": state.kinetic_energy})
+            last_step = state.step
+            last_clock = clock
+
+    # Outputs of the job
+    state = simulation.state()
+    return {"event": "done",
+            "step": state.step,
+            "time": state.time,
+            "kinetic_energy": state.kinetic_energy,
+            "elapsed": perf_counter() - start,
+            "outputs": {"ids": state.ids.tolist(),
+                        "names": [b.name for b in simulation.balls],
+                        "positions": state.positions.tolist(),
+                        "velocities": state.velocities.tolist(),
+                        "history": history}}
+
+def worker_main(connection, cancel):
+    """Run jobs from the connection until told to stop; the physics modules stay imported between jobs"""
+    while True:
+        job = connection.recv()
+        if job is None:
+            return
+        try:
+            result = run_job(job, connection, cancel)
+        except Exception as e:
+            result = {"event": "error", "message": "{}: {}".format(e.__class__.__name__, e)}
+        connection.send(result)
+
+class Job:
+    """A job and the connections that want to hear about it"""
+
+    def __init__(self, number, description):
+        self.number = number
+        self.description = description
+        self.status = "queued"
+        self.listeners = []
+        self.cancel = None
+        self.result = None
+
+        # When the job stopped, so the server can forget it later
+        self.finished = None
+        return
+
+    def finish(self, result):
+        """Keep the last message of the job, which has its outputs"""
+        self.status = result["event"]
+        self.result = result
+        self.cancel = None
+        self.finished = perf_counter()
+        return
+
+class JobServer:
+    """Accepts jobs over a Unix socket or a localhost port and runs them on a pool of worker processes"""
+
+    def __init__(self,
+                 num_workers = None,
+                 path = None,
+                 host = "127.0.0.1",
+                 port = 8765,
+                 keep_finished = 600.0):
+        # Leave one core for the server, if we can
+        self.num_workers = num_workers if num_workers is not None else max(1, (os.cpu_count() or 2) - 1)
+
+        # Listen on a Unix socket if there is a path, otherwise on a local port
+        self.path = path
+        self.host = host
+        self.port = port
+
+        # Jobs by number, and the queue of (priority, number) for the ones that haven't started
+        self.jobs = {}
+        self.next_job = 0
+        self.queue = None
+
+        # Seconds to keep a finished job and its outputs for anyone who watches it late, so the server doesn't fill up
+        self.keep_finished = keep_finished
+
+        # Spawned workers start with a clean interpreter, which is safer than forking a process with threads
+        self.context = multiprocessing.get_context("spawn")
+        self.workers = []
+        return
+
+    def start_worker(self):
+        """Start a worker process, returning the process, our end of its pipe and its cancel flag"""
+        connection, worker_connection = self.context.Pipe()
+        cancel = self.context.Event()
+        process = self.context.Process(target=worker_main, args=(worker_connection, cancel), daemon=True)
+        process.start()
+        worker_connection.close()
+        return process, connection, cancel
+
+    async def serve(self):
+        """Run the server until it is shut down"""
+        self.queue = asyncio.PriorityQueue()
+        self.stopped = asyncio.Event()
+
+        # Waiting for a worker's pipe blocks, so each worker gets its own thread for that
+        self.executor = ThreadPoolExecutor(max_workers=self.num_workers)
+        tasks = [asyncio.create_task(self.run_worker()) for w in range(self.num_workers)]
+        if self.path is not None:
+            server = await asyncio.start_unix_server(self.handle_client, path=self.path)
+            print("Serving on {} with {} workers".format(self.path, self.num_workers))
+        else:
+            server = await asyncio.start_server(self.handle_client, host=self.host, port=self.port)
+            print("Serving on {}:{} with {} workers".format(self.host, self.port, self.num_workers))
+        async with server:
+            await self.stopped.wait()
+
+        # Cancel what is running and let the workers go
+        for job in self.jobs.values():
+            if job.status == "running":
+                job.cancel.set()
+        for t in tasks:
+            t.cancel()
+        for process, connection, cancel in self.workers:
+            connection.send(None)
+            process.join(timeout=5.0)
+            if process.is_alive():
+                process.terminate()
+        self.executor.shutdown(wait=False)
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+        return
+
+    async def run_worker(self):
+        """Give jobs from the queue to one worker process, passing its messages on to the listeners"""
+        loop = asyncio.get_running_loop()
+        worker = self.start_worker()
+        self.workers.append(worker)
+        while True:
+            priority, number = await self.queue.get()
+            job = self.jobs.get(number)
+            if job is None or job.status != "queued":
+                # Cancelled while it was waiting
+                continue
+            process, connection, cancel = worker
+            cancel.clear()
+            job.cancel = cancel
+            job.status = "running"
+            connection.send(job.description)
+            while True:
+                try:
+                    message = await loop.run_in_executor(self.executor, connection.recv)
+                except (EOFError, OSError):
+                    # The worker died, so start a new one for the next job
+                    message = {"event": "error", "message": "worker process stopped"}
+                    self.workers.remove(worker)
+                    worker = self.start_worker()
+                    self.workers.append(worker)
+                message["job"] = number
+                if message["event"] != "progress":
+                    break
+                await self.send(job, message)
+            job.finish(message)
+            await self.send(job, message)
+
+    def forget_finished(self):
+        """Forget the jobs that finished more than keep_finished seconds ago"""
+        now = perf_counter()
+        for number, job in list(self.jobs.items()):
+            if job.finished is not None and now - job.finished > self.keep_finished:
+                del self.jobs[number]
+        return
+
+    def find_job(self, request):
+        """Get the job that a request is about"""
+        number = request.get("job")
+        if number not in self.jobs:
+            raise ValueError("no job {}; finished jobs are only kept for {} seconds".format(number, self.keep_finished))
+        return self.jobs[number]
+
+    async def send(self, job, message):
+        """Send a message to everyone listening to a job, forgetting the ones that have gone away"""
+        for writer in list(job.listeners):
+            if not await self.write(writer, message):
+                job.listeners.remove(writer)
+        return
+
+    async def write(self, writer, message):
+        """Write one line of JSON; returns whether it worked"""
+        try:
+            writer.write(json.dumps(message).encode() + b"\n")
+            await writer.drain()
+        except (ConnectionError, RuntimeError):
+            return False
+        return True
+
+    async def handle_client(self, reader, writer):
+        """Answer the commands from one connection"""
+        try:
+            while not reader.at_eof():
+                line = await reader.readline()
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                    reply = self.handle_command(request, writer)
+                except (ValueError, KeyError, TypeError) as e:
+                    reply = {"event": "error", "message": "{}: {}".format(e.__class__.__name__, e)}
+                await self.write(writer, reply)
+        except (ConnectionError, asyncio.CancelledError):
+            # The client went away, or the server is shutting down
+            pass
+        writer.close()
+        return
+
+    def handle_command(self, request, writer):
+        """Do what a request asks and return the reply"""
+        if not isinstance(request, dict):
+            raise ValueError("a request has to be a JSON object")
+        self.forget_finished()
+        command = request.get("command")
+        if command == "submit":
+            description = check_job(request)
+            number = self.next_job
+            self.queue.put_nowait((description["priority"], number))
+
+            # Only keep the job once it is in the queue
+            self.next_job += 1
+            job = Job(number, description)
+            job.listeners.append(writer)
+            self.jobs[number] = job
+            return {"event": "queued", "job": number, "queued": self.queue.qsize()}
+        if command == "cancel":
+            job = self.find_job(request)
+            if job.status == "queued":
+                job.finish({"event": "cancelled", "job": job.number})
+                for w in job.listeners:
+                    if w is not writer:
+                        asyncio.create_task(self.write(w, job.result))
+            elif job.status == "running":
+                # The worker notices between steps and sends the cancelled message
+                job.cancel.set()
+            return {"event": "cancelling", "job": job.number, "status": job.status}
+        if command == "watch":
+            job = self.find_job(request)
+            if job.result is not None:
+                return job.result
+            job.listeners.append(writer)
+            return {"event": "watching", "job": job.number, "status": job.status}
+        if command == "status":
+            return {"event": "status",
+                    "workers": self.num_workers,
+                    "jobs": [{"job": j.number,
+                              "scenario": j.description["scenario"],
+                              "priority": j.description["priority"],
+                              "status": j.status} for j in self.jobs.values()]}
+        if command == "shutdown":
+            self.stopped.set()
+            return {"event": "shutting down"}
+        raise ValueError("unknown command {}".format(command))
+
+def submit(job, path = None, host = "127.0.0.1", port = 8765):
+    """Send a job to a running server and yield each message about it, ending with the one that has the outputs"""
+    if path is not None:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(path)
+    else:
+        connection = socket.create_connection((host, port))
+    with connection, connection.makefile("rw") as f:
+        f.write(json.dumps(dict(job, command = "submit")) + "\n")
+        f.flush()
+        for line in f:
+            message = json.loads(line)
+            yield message
+            if message["event"] in ["done", "cancelled", "error"]:
+                return
+    return
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run queued simulations on a pool of worker processes")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--socket", default=None, help="path of a Unix socket to listen on")
+    parser.add_argument("--port", type=int, default=8765, help="localhost port to listen on, if there is no socket")
+    parser.add_argument("--keep", type=float, default=600.0, help="seconds to keep the outputs of finished jobs")
+    args = parser.parse_args()
+    asyncio.run(JobServer(args.workers, path = args.socket, port = args.port, keep_finished = args.keep).serve())
@@ -0,0 +1,245 @@
+import numpy as np
+
+class Observer:
+    """Base class for statistics that are gathered while the simulation runs, without keeping every step"""
+
+    def __init__(self, every = 1):
+        # How many steps between updates
+        self.every = every
+
+        # Number of times update has been called
+        self.num_samples = 0
+
+        # Time spent in the observer
+        self.observer_time = 0.0
+
+        # Buffers for the ball arrays
+        self.buffers = {}
+        return
+
+    def attach(self, simulation):
+        """Called when the observer is added to the simulation; defaults to doing nothing"""
+        return
+
+    def update(self, simulation):
+        """Add the current state of the simulation to the statistics; defaults to doing nothing"""
+        return
+
+    def balls_reordered(self, order):
+        """Called when the simulation reorders its balls, so balls[k] is now the ball that was at order[k]; defaults to doing nothing"""
+        return
+
+    def name(self):
+        """Name of the observer for printing"""
+        return self.__class__.__name__
+
+    def ball_array(self, balls, attribute):
+        """Copy an attribute of each ball into a buffer that is reused between updates"""
+        a = self.buffers.get(attribute)
+        if a is None or len(a) != len(balls):
+            a = np.zeros((len(balls), 2))
+            self.buffers[attribute] = a
+        for k, b in enumerate(balls):
+            a[k] = getattr(b, attribute)
+        return a
+
+class VelocityHistogram(Observer):
+    """Running histogram of the speed of the balls, or of one component of the velocity"""
+
+    def __init__(self,
+                 velocity_range,
+                 num_bins = 50,
+                 component = None,
+                 every = 1):
+        super().__init__(every)
+        self.edges = np.linspace(velocity_range[0], velocity_range[1], num_bins + 1)
+        self.counts = np.zeros(num_bins)
+        self.component = component
+        return
+
+    def update(self, simulation):
+        velocities = self.ball_array(simulation.balls, "velocity")
+        if self.component is None:
+            values = np.sqrt(np.einsum('bd,bd->b', velocities, velocities))
+        else:
+            values = velocities[:, self.component]
+        self.counts += np.histogram(values, self.edges)[0]
+        self.num_samples += 1
+        return
+
+    def distribution(self):
+        """Normalized probability density for each bin"""
+        total = np.sum(self.counts)
+        if total == 0:
+            return np.zeros_like(self.counts)
+        return self.counts / (total * np.diff(self.edges))
+
+class TimeAverage(Observer):
+    """Running mean and variance of any quantity, like lambda simulation: simulation.kinetic_energy"""
+
+    def __init__(self,
+                 quantity,
+                 every = 1):
+        super().__init__(every)
+        self.quantity = quantity
+        self.mean = 0.0
+        self.sum_squares = 0.0
+        return
+
+    def update(self, simulation):
+        # Welford's method, https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Welford's_online_algorithm
+        value = np.asarray(self.quantity(simulation), dtype=float)
+        self.num_samples += 1
+        delta = value - self.mean
+        self.mean = self.mean + delta / self.num_samples
+        self.sum_squares = self.sum_squares + delta * (value - self.mean)
+        return
+
+    def variance(self):
+        if self.num_samples < 2:
+            return np.zeros_like(self.mean)
+        return self.sum_squares / (self.num_samples - 1)
+
+class RadialDistribution(Observer):
+    """Radial distribution function g(r), using the simulation's spatial index to find the pairs closer than max_distance"""
+
+    def __init__(self,
+                 max_distance,
+                 num_bins = 50,
+                 area = None,
+                 every = 10):
+        super().__init__(every)
+        self.edges = np.linspace(0.0, max_distance, num_bins + 1)
+        self.counts = np.zeros(num_bins)
+        self.area = area
+
+        # Sum of the number of pairs over all the samples, for normalizing
+        self.total_pairs = 0.0
+        return
+
+    def attach(self, simulation):
+        if self.area is None:
+            if simulation.box is None:
+                raise ValueError("RadialDistribution needs an area if there is no box")
+            self.area = np.prod([np.diff(simulation.box.limits(d))[0] for d in range(2)])
+        return
+
+    def update(self, simulation):
+        index = simulation.spatial_index()
+        i, j = index.query_pairs(self.edges[-1])
+        r = index.positions[i] - index.positions[j]
+        self.counts += np.histogram(np.sqrt(np.einsum('pd,pd->p', r, r)), self.edges)[0]
+        num_balls = len(simulation.balls)
+        self.total_pairs += 0.5 * num_balls * (num_balls - 1)
+        self.num_samples += 1
+        return
+
+    def distribution(self):
+        """g(r) at the center of each bin, relative to balls spread evenly over the area"""
+        shell_areas = np.pi * np.diff(self.edges ** 2)
+        expected = self.total_pairs * shell_areas / self.area
+        return 0.5 * (self.edges[1:] + self.edges[:-1]), self.counts / np.maximum(expected, 1.0e-300)
+
+class WallPressure(Observer):
+    """Time-averaged pressure (force per length) on each wall, from the momentum the balls transfer to it"""
+
+    def __init__(self, every = 1):
+        super().__init__(every)
+        self.box = None
+        return
+
+    def attach(self, simulation):
+        if simulation.box is None:
+            raise ValueError("WallPressure needs a box")
+        self.box = simulation.box
+        self.start_time = simulation.time
+        self.end_time = simulation.time
+        self.start_impulse = self.box.wall_impulse.copy()
+        return
+
+    def update(self, simulation):
+        # The box adds up the momentum transfer, so all we need is the time
+        self.end_time = simulation.time
+        self.num_samples += 1
+        return
+
+    def pressure(self):
+        """Pressure on each wall between attaching the observer and the last update"""
+        elapsed = self.end_time - self.start_time
+        if elapsed <= 0.0:
+            return np.zeros_like(self.start_impulse)
+        impulse = self.box.wall_impulse - self.start_impulse
+        return impulse / (elapsed * self.box.wall_lengths())
+
+class MeanSquaredDisplacement(Observer):
+    """Mean squared displacement of the balls from where they were when the observer was attached"""
+
+    def __init__(self,
+                 max_samples = 1000,
+                 every = 1):
+        super().__init__(every)
+
+        # When the history fills up, every other sample is dropped and the samples are taken half as often
+        self.max_samples = max_samples
+        self.stride = 1
+        self.times = np.zeros(max_samples)
+        self.values = np.zeros(max_samples)
+        self.num_stored = 0
+        self.value = 0.0
+        return
+
+    def attach(self, simulation):
+        self.reset(simulation)
+        return
+
+    def reset(self, simulation):
+        """Start measuring the displacement from the current positions"""
+        positions = self.ball_array(simulation.balls, "position")
+        self.last_positions = positions.copy()
+        self.displacements = np.zeros_like(positions)
+        self.buffers.pop("change", None)
+        self.start_time = simulation.time
+        return
+
+    def balls_reordered(self, order):
+        # Keep each ball's displacement with the ball
+        if len(order) == len(self.last_positions):
+            self.last_positions[:] = self.last_positions[order]
+            self.displacements[:] = self.displacements[order]
+        return
+
+    def update(self, simulation):
+        if len(simulation.balls) != len(self.last_positions):
+            # Balls have been added or removed, so start over
+            self.reset(simulation)
+
+        # Add up the change in position, taking the shortest way across periodic boundaries
+        positions = self.ball_array(simulation.balls, "position")
+        change = self.buffers.setdefault("change", np.zeros_like(positions))
+        np.subtract(positions, self.last_positions, out=change)
+        box = simulation.box
+        if box is not None and not box.reflect:
+            for d in range(2):
+                width = np.diff(box.limits(d))[0]
+                change[:, d] -= width * np.round(change[:, d] / width)
+        self.displacements += change
+        self.last_positions[:] = positions
+        self.value = np.mean(np.einsum('bd,bd->b', self.displacements, self.displacements))
+
+        # Keep a history with a fixed size
+        self.num_samples += 1
+        if self.num_samples % self.stride == 0:
+            if self.num_stored == self.max_samples:
+                half = self.max_samples // 2
+                self.times[:half] = self.times[1::2][:half]
+                self.values[:half] = self.values[1::2][:half]
+                self.num_stored = half
+                self.stride *= 2
+            self.times[self.num_stored] = simulation.time - self.start_time
+            self.values[self.num_stored] = self.value
+            self.num_stored += 1
+        return
+
+    def history(self):
+        """Times and mean squared displacements that have been kept"""
+        return self.times[:self.num_stored], self.values[:self.num_stored]
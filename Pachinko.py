@@ -0,0 +1,45 @@
+from Ball import Ball
+from Boundary import Polygon
+from Physics import Collision, ConstantAcceleration
+from Simulation import Simulation
+
+import numpy as np
+
+# Container with a funnel at the bottom
+container = [[0.0, 0.2], [0.45, 0.0], [0.55, 0.0], [1.0, 0.2], [1.0, 1.5], [0.0, 1.5]]
+
+# Rows of round pegs, each made of many short walls
+num_sides = 24
+peg_radius = 0.03
+angles = np.linspace(0.0, 2 * np.pi, num_sides, endpoint=False)
+circle = peg_radius * np.array([np.cos(angles), np.sin(angles)]).T
+pegs = []
+for row in range(5):
+    y = 0.35 + 0.15 * row
+    offset = 0.0 if row % 2 == 0 else 0.075
+    for x in np.arange(0.1 + offset, 0.95, 0.15):
+        pegs.append(circle + [x, y])
+
+box = Polygon(container, obstacles=pegs)
+
+# Drop balls from the top
+num_balls = 40
+balls = [Ball() for i in range(num_balls)]
+for i, b in enumerate(balls):
+    b.randomize(position_range = [0.05, 0.45],
+                velocity_range = [-0.1, 0.1],
+                max_radius = 0.02,
+                radius_range = 1.5,
+                other_balls = [i, balls])
+    b.position[0] *= 2.0
+    b.position[1] += 1.0
+box.check_inside(balls)
+
+physics = [Collision(evolve_spring_constant = True), ConstantAcceleration()]
+
+simulation = Simulation(balls, physics, box)
+simulation.time_step = 0.0005
+simulation.num_time_steps = 4001
+simulation.visualization_step = 20
+
+simulation.run()
@@ -1,10 +1,25 @@
 import numpy as np
+import time
+
+from Workspace import Workspace
 
 class Physics:
     """Base class for all physics"""
     
     def __init__(self):
         self.physics_time = 0.0
+        self.simulation = None
+
+        # Arrays calculated from the masses, charges, radii and pairs, kept until the workspace changes
+        self.cache = {}
+        self.cache_workspace = None
+        self.cache_version = -1
+        self.cache_current = set()
+
+    def set_simulation(self, simulation):
+        """Called by the simulation, so packages can use things like simulation.spatial_index()"""
+        self.simulation = simulation
+        return
 
     def pre_step_update(self, balls, time_step):
         """This runs before the forces are calculated; defaults to doing nothing"""
@@ -14,6 +29,45 @@ class Physics:
         """Add forces to the balls; defaults to doing nothing"""
         return
 
+    def name(self):
+        """Name of the package for printing"""
+        return self.__class__.__name__
+
+    def depends_on_velocity(self):
+        """Whether the forces depend on the velocities of the balls, which is assumed unless a package says otherwise"""
+        return True
+
+    def defined_here(self, names):
+        """Check whether these methods all come from this file, so a subclass hasn't changed them"""
+        for name in names:
+            method = getattr(type(self), name, None)
+            if method is not None and method.__module__ != __name__:
+                return False
+        return True
+
+    def get_workspace(self, balls):
+        """Get the simulation's workspace, which holds the state of the balls during add_force, or make a new one"""
+        if self.simulation is not None and self.simulation.workspace.balls is balls:
+            return self.simulation.workspace
+        workspace = Workspace()
+        workspace.gather(balls)
+        return workspace
+
+    def cached_array(self, workspace, name, shape):
+        """Get an array that the package keeps between steps, and whether it is still current for the masses, charges, radii and pairs in the workspace"""
+        if workspace is not self.cache_workspace or workspace.version != self.cache_version:
+            self.cache_workspace = workspace
+            self.cache_version = workspace.version
+            self.cache_current = set()
+        a = self.cache.get(name)
+        if a is None or a.shape != shape:
+            a = np.zeros(shape)
+            self.cache[name] = a
+            self.cache_current.discard(name)
+        current = name in self.cache_current
+        self.cache_current.add(name)
+        return a, current
+
 class BallEnvironmentPhysics(Physics):
     """Base class for physics involving the interaction of a ball with its environment"""
     
@@ -27,6 +81,8 @@ class BallEnvironmentPhysics(Physics):
         """Add a force between the ball and its environment"""
         num_balls = len(balls)
         for i in range(num_balls):
+            if balls[i].asleep:
+                continue
             forces[i][:] += self.force_be(balls[i])
         return
     
@@ -43,6 +99,21 @@ class ConstantAcceleration(BallEnvironmentPhysics):
     def force_be(self, balli):
         return self.acceleration * balli.mass
 
+    def depends_on_velocity(self):
+        return not self.defined_here(["add_force", "force_be"])
+
+    def add_force(self, balls, forces):
+        workspace = self.get_workspace(balls)
+        awake = workspace.awake_indices
+        if awake is not None:
+            # Sleeping balls don't move, so only the awake ones need the force
+            forces[awake] += workspace.masses[awake, np.newaxis] * self.acceleration
+            return
+        force = workspace.array("constant_acceleration", workspace.positions.shape)
+        np.multiply(workspace.masses[:, np.newaxis], self.acceleration, out=force)
+        forces[:len(force)] += force
+        return
+
 class ConstantElectromagneticField(BallEnvironmentPhysics):
     """Adds a background electromagnetic field"""
     
@@ -58,6 +129,24 @@ class ConstantElectromagneticField(BallEnvironmentPhysics):
         v_cross_B = self.B * np.array([balli.velocity[1], -balli.velocity[0]])
         return balli.charge * (self.E + v_cross_B)
 
+    def add_force(self, balls, forces):
+        workspace = self.get_workspace(balls)
+        awake = workspace.awake_indices
+        if awake is not None:
+            # Only the awake balls, since sleeping balls don't move
+            velocities = workspace.velocities[awake]
+            v_cross_B = self.B * np.stack([velocities[:, 1], -velocities[:, 0]], axis=1)
+            forces[awake] += workspace.charges[awake, np.newaxis] * (self.E + v_cross_B)
+            return
+        velocities = workspace.velocities
+        force = workspace.array("electromagnetic_field", velocities.shape)
+        np.multiply(velocities[:, 1], self.B, out=force[:, 0])
+        np.multiply(velocities[:, 0], -self.B, out=force[:, 1])
+        force += self.E
+        force *= workspace.charges[:, np.newaxis]
+        forces[:len(force)] += force
+        return
+
 class Drag(BallEnvironmentPhysics):
     """Adds drag for problems where velocities would otherwise increase forever"""
     
@@ -75,7 +164,32 @@ class Drag(BallEnvironmentPhysics):
             return np.zeros_like(balli.velocity)
         direction = -balli.velocity / velocity_mag
         return direction * velocity_mag * (self.linear + velocity_mag * self.quadratic)
+
+    def add_force(self, balls, forces):
+        # F = -v * (linear + quadratic * |v|), which is zero when v is zero
+        workspace = self.get_workspace(balls)
+        awake = workspace.awake_indices
+        if awake is not None:
+            # Only the awake balls, since sleeping balls don't move
+            velocities = workspace.velocities[awake]
+            speeds = np.sqrt(np.einsum('bd,bd->b', velocities, velocities))
+            forces[awake] -= velocities * (self.linear + self.quadratic * speeds)[:, np.newaxis]
+            return
+        velocities = workspace.velocities
+        coeff = workspace.array("drag_coeff", (len(velocities),))
+        force = workspace.array("drag", velocities.shape)
+        np.einsum('bd,bd->b', velocities, velocities, out=coeff)
+        np.sqrt(coeff, out=coeff)
+        coeff *= -self.quadratic
+        coeff -= self.linear
+        np.multiply(velocities, coeff[:, np.newaxis], out=force)
+        forces[:len(force)] += force
+        return
     
+# Methods that make up a pair kernel, and the methods that give the force for one pair, which the kernel has to agree with
+pair_kernel_methods = ["pair_coefficients", "add_pair_coefficients", "pair_r2_coeff"]
+pair_force_methods = ["force_bb", "force_r2_coeff"]
+
 class BallBallPhysics(Physics):
     """Base class for physics involving the interactions of two balls"""
     
@@ -87,6 +201,12 @@ class BallBallPhysics(Physics):
                   balls,
                   forces):
         """Add a force between the ball and another ball"""
+        if self.has_pair_kernel():
+            # Use the pair kernel, which handles all the pairs at once
+            add_pair_forces([self], balls, forces, self.get_workspace(balls))
+            return
+        
+        # No pair kernel: go through the pairs one at a time with force_bb
         num_balls = len(balls)
         for i in range(num_balls):
             for j in range(i+1, num_balls):
@@ -97,6 +217,92 @@ class BallBallPhysics(Physics):
                 forces[i][:] += forceij
                 forces[j][:] -= forceij
         return
+
+    def pair_coefficients(self, balls, i, j, r2, dist):
+        """Pair kernel: for the pairs of ball indices i and j, return c such that the force on ball i from ball j is c * r, where r = x_i - x_j; not defined by default"""
+        raise NotImplementedError("{} does not define a pair kernel".format(self.__class__.__name__))
+
+    def add_pair_coefficients(self, workspace, coeff):
+        """Pair kernel that adds to coeff in place using the arrays in the workspace; defaults to calling pair_coefficients"""
+        coeff += self.pair_coefficients(workspace.balls, workspace.pair_i, workspace.pair_j, workspace.r2, workspace.dist)
+        return
+
+    def has_pair_kernel(self):
+        """Check whether this package defines a pair kernel that its force_bb or force_r2_coeff hasn't been changed below"""
+        # Find the most derived class that defines a pair kernel
+        classes = type(self).__mro__
+        kernel = None
+        for k, c in enumerate(classes):
+            if c is BallBallPhysics:
+                return False
+            if any(name in vars(c) for name in pair_kernel_methods):
+                kernel = k
+                break
+        if kernel is None:
+            return False
+
+        # A subclass that changes the force for one pair, like a softer Gravity, has to go through the pairs one at a time
+        for c in classes[:kernel]:
+            if any(name in vars(c) for name in pair_force_methods):
+                return False
+        return True
+
+    def fusable(self):
+        """Check whether this package can share a pair traversal with other packages"""
+        return self.has_pair_kernel() and type(self).add_force is BallBallPhysics.add_force
+
+def add_pair_forces(packages, balls, forces, workspace):
+    """Add the forces from several pair kernels, calculating the separation of each pair only once"""
+    if len(balls) < 2:
+        return
+    workspace.update_separations()
+
+    # Sum the force coefficients from each package
+    coeff = workspace.coeff
+    coeff.fill(0.0)
+    for p in packages:
+        timer = time.perf_counter()
+        p.add_pair_coefficients(workspace, coeff)
+        p.physics_time += time.perf_counter() - timer
+    
+    # Equal and opposite forces
+    workspace.add_pair_forces(forces)
+    return
+
+class FusedBallBallPhysics(Physics):
+    """Runs several ball-ball physics packages in a single traversal of the pairs"""
+    
+    def __init__(self, packages):
+        super().__init__()
+        self.packages = packages
+        return
+
+    def add_force(self, balls, forces):
+        """Add the forces from all the packages at once"""
+        add_pair_forces(self.packages, balls, forces, self.get_workspace(balls))
+        return
+
+    def name(self):
+        return "Fused({})".format(", ".join(p.__class__.__name__ for p in self.packages))
+
+    def depends_on_velocity(self):
+        return any(p.depends_on_velocity() for p in self.packages)
+
+def fuse_physics(physics):
+    """Replace the ball-ball packages that have pair kernels with a single fused package"""
+    packages = [p for p in physics if isinstance(p, BallBallPhysics) and p.fusable()]
+    if len(packages) < 2:
+        return list(physics)
+    fused = FusedBallBallPhysics(packages)
+    
+    # Put the fused package where the first of its packages was
+    result = []
+    for p in physics:
+        if p is packages[0]:
+            result.append(fused)
+        elif not any(p is q for q in packages):
+            result.append(p)
+    return result
     
 class R2Physics(BallBallPhysics):
     """Base class for charge and gravity physics"""
@@ -118,6 +324,30 @@ class R2Physics(BallBallPhysics):
         # Force (from descendant classes)
         return self.force_r2_coeff(balli, ballj) * rhat / r2
 
+    def depends_on_velocity(self):
+        return not self.defined_here(["add_force"] + pair_kernel_methods + pair_force_methods)
+
+    def add_pair_coefficients(self, workspace, coeff):
+        # F = coeff * rhat / r^2 = coeff * r / r^3
+        r3 = workspace.array("r3", coeff.shape)
+        np.multiply(workspace.r2, workspace.dist, out=r3)
+
+        # The coefficients only depend on the masses or charges, so they are only recalculated when those change
+        r2_coeff, current = self.cached_array(workspace, "r2_coeff", coeff.shape)
+        if not current:
+            self.pair_r2_coeff(workspace, r2_coeff)
+        np.divide(r2_coeff, r3, out=r3)
+        coeff += r3
+        return
+
+    def pair_product(self, workspace, values, out):
+        """Put values[i] * values[j] for each pair into out"""
+        scratch = workspace.array("pair_product", out.shape)
+        np.take(values, workspace.pair_i, out=out, mode='clip')
+        np.take(values, workspace.pair_j, out=scratch, mode='clip')
+        out *= scratch
+        return
+
 class Charge(R2Physics):
     """Calculates the electrostatic force between two charged particles"""
     
@@ -133,6 +363,11 @@ class Charge(R2Physics):
         # F = q1 * q2 / (4 * pi * e0) * rhat / r^2
         # https://en.wikipedia.org/wiki/Coulomb%27s_law#Vector_form_of_the_law
         return self.k * balli.charge * ballj.charge
+
+    def pair_r2_coeff(self, workspace, out):
+        self.pair_product(workspace, workspace.charges, out)
+        out *= self.k
+        return
     
 class Gravity(R2Physics):
     """Calculates the gravitational force between two objects"""
@@ -150,6 +385,11 @@ class Gravity(R2Physics):
         # https://en.wikipedia.org/wiki/Newton%27s_law_of_universal_gravitation#Vector_form
         return -self.G * balli.mass * ballj.mass
 
+    def pair_r2_coeff(self, workspace, out):
+        self.pair_product(workspace, workspace.masses, out)
+        out *= -self.G
+        return
+
 class Collision(BallBallPhysics):
     """Calculates collision between balls"""
 
@@ -158,6 +398,13 @@ class Collision(BallBallPhysics):
         super().__init__()
         self.evolve_spring_constant = evolve_spring_constant
         self.spring_constant = 1.0e5 # kg / s^2
+
+        # Time step that an evolving spring is made for, or None for the time step of each step
+        self.spring_time_step = None
+
+        # Pairs of touching balls from the last step, if asked for
+        self.record_contacts = False
+        self.contacts = None
         return
 
     def pre_step_update(self, balls, time_step):
@@ -170,12 +417,23 @@ class Collision(BallBallPhysics):
             # self.spring_constant = average_mass * (max_velocity / min_radius) ** 2
             
             # My method, works better: limits velocity change (on average) to at most the current velocity
-            velocities = np.array([np.linalg.norm(b.velocity) for b in balls])
-            masses = np.array([b.mass for b in balls])
-            radii = np.array([b.radius for b in balls])
-            constants = velocities * masses / (radii * time_step)
-            self.spring_constant = np.mean(constants)
+            self.spring_constant = self.spring_impulse(balls) / (time_step if self.spring_time_step is None else self.spring_time_step)
         return
+
+    def spring_impulse(self, balls):
+        """Spring constant times the time step, which is what evolve_spring_constant keeps the same for any time step"""
+        workspace = self.simulation.workspace if self.simulation is not None else Workspace()
+        workspace.gather_properties(balls)
+        mass_per_radius, current = self.cached_array(workspace, "mass_per_radius", (len(balls),))
+        if not current:
+            np.divide(workspace.masses, workspace.radii, out=mass_per_radius)
+
+        # Only the velocities change from step to step
+        speeds = workspace.array("collision_speeds", (len(balls),))
+        for k, b in enumerate(balls):
+            speeds[k] = np.sqrt(b.velocity[0] * b.velocity[0] + b.velocity[1] * b.velocity[1])
+        speeds *= mass_per_radius
+        return np.mean(speeds)
         
     def force_bb(self, balli, ballj):
         # Vector from center of one ball to center of the other
@@ -195,4 +453,34 @@ class Collision(BallBallPhysics):
         
         # Hooke's law!
         return self.spring_constant * overlap * rhat
-    
+
+    def depends_on_velocity(self):
+        # The spring constant can depend on the velocities, but it is only changed in pre_step_update
+        return not self.defined_here(["add_force"] + pair_kernel_methods + pair_force_methods)
+
+    def add_pair_coefficients(self, workspace, coeff):
+        dist = workspace.dist
+        
+        # Check whether balls overlap: overlap = r_i + r_j - dist
+        radius_sums, current = self.cached_array(workspace, "radius_sums", coeff.shape)
+        if not current:
+            np.take(workspace.radii, workspace.pair_i, out=radius_sums, mode='clip')
+            radius_sums += workspace.radii[workspace.pair_j]
+        overlap = workspace.array("overlap", coeff.shape)
+        np.subtract(radius_sums, dist, out=overlap)
+        np.maximum(overlap, 0.0, out=overlap)
+        if self.record_contacts:
+            touching = np.nonzero(overlap)[0]
+            self.contacts = (workspace.pair_i[touching], workspace.pair_j[touching])
+
+        # Hooke's law, with r / dist as the normalized vector
+        touching = workspace.array("touching", coeff.shape, dtype=bool)
+        np.greater(dist, 0.0, out=touching)
+        np.divide(overlap, dist, out=overlap, where=touching)
+
+        # Balls right on top of each other have no direction, so no force
+        np.logical_not(touching, out=touching)
+        np.copyto(overlap, 0.0, where=touching)
+        overlap *= self.spring_constant
+        coeff += overlap
+        return
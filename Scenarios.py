@@ -0,0 +1,142 @@
+from Ball import Ball
+from Boundary import Box
+from Physics import Charge, Collision, ConstantAcceleration, ConstantElectromagneticField, Drag, Gravity
+from Simulation import Simulation
+from BlackHoleExercise import BlackHoleGravity
+
+import numpy as np
+import os
+
+# Each scenario makes the same setup as one of the example scripts, without running it.
+# They return a dictionary with the balls, physics, box, limits and time step.
+
+def bouncy_balls(num_balls = 20):
+    balls = [Ball() for i in range(num_balls)]
+    for b in balls:
+        b.randomize(max_radius = 0.05, radius_range = 2.0)
+    return {"balls": balls,
+            "physics": [Collision(evolve_spring_constant = True), ConstantAcceleration()],
+            "box": Box(0.0, 1.0, 0.0, 1.0, reflect=True),
+            "time_step": 0.0005}
+
+def orbiting_stars(num_balls, xlim, gravity):
+    """Small stars in roughly circular orbits around a big star, as in BouncyStars.py and BlackHoleExercise.py"""
+    max_mass = 1.0e33
+    max_radius = 2 * xlim / 40
+    balls = [Ball() for i in range(num_balls)]
+    balls[0].position[:] = 0.0
+    balls[0].mass = max_mass * 1.0e2
+    balls[0].radius = max_radius * 4
+    for i in range(1, num_balls):
+        b = balls[i]
+        b.randomize(position_range = [-xlim, xlim],
+                    max_mass = max_mass,
+                    max_radius = max_radius,
+                    radius_range = 4.0,
+                    other_balls = [i, balls])
+
+        # Calculate stable orbital velocity
+        b.velocity[0] = -b.position[1]
+        b.velocity[1] = b.position[0]
+        dist_from_center = np.linalg.norm(b.position)
+        b.velocity /= dist_from_center
+        b.velocity *= np.sqrt(gravity.G * balls[0].mass / dist_from_center)
+
+        # Perturb the velocity a bit to make the orbits elliptical
+        b.velocity *= np.random.uniform(0.8, 1.2)
+    return balls
+
+def bouncy_stars(num_balls = 50):
+    xlim = 1.0e12
+    xboxlim = 1.5 * xlim
+    gravity = Gravity()
+    balls = orbiting_stars(num_balls, xlim, gravity)
+    return {"balls": balls,
+            "physics": [gravity, Collision(evolve_spring_constant = True)],
+            "box": Box(-xboxlim, xboxlim, -xboxlim, xboxlim, reflect=False),
+            "time_step": 20 * 60.0}
+
+def black_hole(num_balls = 50):
+    xlim = 1.0e12
+    xboxlim = 1.5 * xlim
+    balls = orbiting_stars(num_balls, xlim, Gravity())
+    return {"balls": balls,
+            "physics": [BlackHoleGravity(balls[0])],
+            "limits": [[-xboxlim, xboxlim], [-xboxlim, xboxlim]],
+            "time_step": 20 * 60.0}
+
+def magnetic_rotation(num_balls = 10):
+    balls = [Ball() for i in range(num_balls)]
+    for i, b in enumerate(balls):
+        b.charge = -1.0e-5
+        b.velocity[0] = 1.0
+        b.position[1] = i * 2.0
+        b.radius = 0.5
+    lim = num_balls * 2.0 + 1.0
+    return {"balls": balls,
+            "physics": [ConstantElectromagneticField(B=1.0e5), Drag(quadratic=0.01), Charge()],
+            "limits": [[-lim, lim], [-0.5 * lim, 1.5 * lim]],
+            "time_step": 0.2}
+
+def solar_system():
+    balls = []
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "SolarSystemData.txt")) as f:
+        descriptions = [d.lower() for d in f.readline().split('\t')]
+        fields = {v:[i for i, d in enumerate(descriptions) if v in d][0] for v in ["body", "distance", "mass", "diameter", "orbitalvelocity", "color"]}
+        for l in f:
+            data = l.strip().split('\t')
+            name = data[fields["body"]].lower()
+            if name == "moon":
+                continue
+            balls.append(Ball(position = [float(data[fields["distance"]]), 0.0],
+                              velocity = [0.0, float(data[fields["orbitalvelocity"]])],
+                              mass = float(data[fields["mass"]]),
+                              radius = 0.5 * float(data[fields["diameter"]]),
+                              color = "#{}".format(data[fields["color"]]),
+                              name = name))
+    lim = 1.1 * max(b.position[0] for b in balls)
+    return {"balls": balls,
+            "physics": [Gravity()],
+            "limits": [[-lim, lim], [-lim, lim]],
+            "time_step": 10.0 * 24.0 * 3600.0}
+
+def tatooine():
+    velocity_fix = 1.2e4
+    balls = [Ball(position = [-1.62e9, 0.0],
+                  velocity = [0.0, 4.42e4 - velocity_fix],
+                  mass = 3.07e30,
+                  radius = 1.07e9 * 3,
+                  name = "Tatoo I"),
+             Ball(position = [5.48e9, 0.0],
+                  velocity = [0.0, -9.68e4 - velocity_fix],
+                  mass = 9.09e29,
+                  radius = 7.10e8 * 3,
+                  name = "Tatoo II"),
+             Ball(position = [1.65e11, 0.0],
+                  velocity = [0.0, 4.11e4 - velocity_fix],
+                  mass = 2.93e24,
+                  radius = 5.00e6 * 50,
+                  name = "Tatooine")]
+    lim = 1.1 * balls[-1].position[0]
+    return {"balls": balls,
+            "physics": [Gravity()],
+            "limits": [[-lim, lim], [-lim, lim]],
+            "time_step": 3600.0}
+
+scenarios = {"BouncyBalls": bouncy_balls,
+             "BouncyStars": bouncy_stars,
+             "BlackHole": black_hole,
+             "MagneticRotation": magnetic_rotation,
+             "SolarSystem": solar_system,
+             "Tatooine": tatooine}
+
+def make_simulation(name, seed = 0, **kwargs):
+    """Make a headless simulation for a scenario, with a fixed random seed"""
+    np.random.seed(seed)
+    setup = scenarios[name](**kwargs)
+    simulation = Simulation(setup["balls"], setup["physics"],
+                            box = setup.get("box"),
+                            limits = setup.get("limits"),
+                            visualize = False)
+    simulation.time_step = setup["time_step"]
+    return simulation
@@ -2,27 +2,115 @@ import numpy as np
 from matplotlib import pyplot as plt
 from matplotlib import collections as mc
 import time
+from time import perf_counter
+import tracemalloc
+
+from Physics import fuse_physics
+from SpatialIndex import KDTree, morton_order
+from Workspace import Workspace
+
+class State:
+    """A lightweight snapshot of the simulation; the ball arrays are only made if they are asked for"""
+
+    def __init__(self, simulation):
+        self.simulation = simulation
+        self.step = simulation.step_count
+        self.time = simulation.time
+        self.time_step = simulation.time_step
+        self.kinetic_energy = simulation.kinetic_energy
+        return
+
+    def ball_array(self, attribute):
+        """Read-only array of an attribute of each ball, which has to be made before the simulation takes another step"""
+        if self.simulation.step_count != self.step:
+            raise ValueError("State is from step {}, but the simulation is on step {}".format(self.step, self.simulation.step_count))
+        values = np.array([getattr(b, attribute) for b in self.simulation.balls])
+        values.flags.writeable = False
+        return values
+
+    @property
+    def positions(self):
+        return self.ball_array("position")
+
+    @property
+    def velocities(self):
+        return self.ball_array("velocity")
+
+    @property
+    def ids(self):
+        return self.ball_array("id")
 
 class Simulation:
+    # min_dv and max_dv used to halve or double the time step in the middle of a step, and are gone now,
+    # so scripts that still set them find out instead of quietly running with a fixed time step
+
+    @property
+    def min_dv(self):
+        raise AttributeError("min_dv has been replaced by simulation.time_step_controller = AdaptiveTimeStep(...) from Integrator.py")
+
+    @min_dv.setter
+    def min_dv(self, value):
+        raise AttributeError("min_dv has been replaced by simulation.time_step_controller = AdaptiveTimeStep(...) from Integrator.py")
+
+    @property
+    def max_dv(self):
+        raise AttributeError("max_dv has been replaced by simulation.time_step_controller = AdaptiveTimeStep(...) from Integrator.py")
+
+    @max_dv.setter
+    def max_dv(self, value):
+        raise AttributeError("max_dv has been replaced by simulation.time_step_controller = AdaptiveTimeStep(...) from Integrator.py")
+
     def __init__(self,
                  balls,
                  physics,
                  box = None,
-                 limits = None):
+                 limits = None,
+                 visualize = True):
         # Input data
         self.balls = balls
         self.physics = physics
         self.box = box
         self.limits = limits
+        self.visualize = visualize
+
+        # Run compatible ball-ball packages in a single pair traversal
+        self.fuse_pairs = True
+        self.force_physics = None
+        self.force_physics_key = None
+
+        # Arrays reused each step, resized only if the number of balls changes
+        self.workspace = Workspace()
+
+        # Puts balls that have stopped moving to sleep, if set
+        self.sleeping = None
+
+        # Moves the balls forward in time, like Integrator.WisdomHolman, or None for the Euler update below
+        self.integrator = None
+
+        # Statistics gathered as the simulation runs
+        self.observers = []
+
+        # Spatial index of the ball positions, made only when someone asks for it
+        self.index = None
+        self.index_key = None
+        self.index_refits = 0
+
+        # Goes up whenever balls are moved during a step, so the spatial index knows it is out of date
+        self.position_version = 0
+        self.index_rebuild_step = 20
+
+        # Sort the balls along a space-filling curve every this many steps, so balls that are close together
+        # are close together in the arrays; 0 to never sort them
+        self.reorder_step = 0
 
         # Time stepping options
+        self.step_count = 0
         self.time = 0.0
         self.time_step = 1.0
         self.num_time_steps = 1000
 
-        # Minimum and maximum delta velocity for the time step
-        self.min_dv = 0.0
-        self.max_dv = np.inf
+        # Chooses the time step each step, like Integrator.AdaptiveTimeStep, or None to keep it fixed
+        self.time_step_controller = None
 
         # How often we update the visualization and print info
         self.visualization_step = 1
@@ -35,88 +123,271 @@ class Simulation:
         self.physics_time = 0.0
         self.visualization_time = 0.0
         self.boundary_time = 0.0
+
+        # Measure memory allocated in each part of the step, which slows things down
+        self.track_allocations = False
+        self.allocations = {}
+        
+        # Let the physics packages know about the simulation
+        for p in self.physics:
+            p.set_simulation(self)
         
         # Start up the visualization
         self.initialize_visualization()
 
         # Print starting message
-        self.print_welcome()
+        if self.visualize:
+            self.print_welcome()
         
         return
 
     def run(self):
-        num_balls = len(self.balls)
-        dimension = 2
-        min_dv = np.inf
-        max_dv = 0.0
+        """Run for num_time_steps, printing and plotting along the way"""
+        if self.track_allocations:
+            tracemalloc.start()
         print("{:>7} {:>11} {:>11} {:>13}".format("step", "time", "time step", "kin energy"))
         for s in range(self.num_time_steps):
             if s % self.print_step == 0:
                 print("{:7} {:11.4g} {:11.4g} {:13.3e}".format(s, self.time, self.time_step, self.kinetic_energy))
-            
-            # Start our timer
-            timer = time.perf_counter()
-            
-            # Prepare things before calculating the forces
-            for p in self.physics:
-                physics_timer = time.perf_counter()
-                p.pre_step_update(self.balls, self.time_step)
-                p.physics_time += time.perf_counter() - physics_timer
-            
-            # Get the forces on each ball
-            forces = np.zeros((num_balls, dimension))
-            for p in self.physics:
-                physics_timer = time.perf_counter()
-                p.add_force(self.balls, forces)
-                p.physics_time += time.perf_counter() - physics_timer
-            for i, b in enumerate(self.balls):
-                # Calculate the acceleration from the force
-                # F = m * a, so a = F / m
-                acceleration = forces[i][:] / b.mass
-                
-                # Increase the velocity
-                # v = v0 + dt * a
-                dv = self.time_step * acceleration
-                b.velocity += dv
-
-                # Increase the position
-                # x = x0 + dt * v
-                self.update_position(b)
-                # b.position += self.time_step * b.velocity
-                
-                # Adjust the time step, if needed
-                dvmag = np.linalg.norm(dv)
-                min_dv = min(min_dv, dvmag)
-                max_dv = max(max_dv, dvmag)
-                if (min_dv < self.min_dv):
-                    self.time_step *= 2.0
-                elif max_dv > self.max_dv:
-                    self.time_step *= 0.5
-                    
-            # Update the kinetic energy
-            self.update_kinetic_energy()
 
-            # Add to our time
-            self.physics_time += time.perf_counter() - timer
+            # Move everything forward in time
+            self.step()
             
             # Plot the new state
             if (s + 1) % self.visualization_step == 0:
                 self.update_visualization()
-            
-            # Increment the time
-            self.time += self.time_step
+        if self.track_allocations:
+            tracemalloc.stop()
         self.print_timers()
-        plt.show(block=True)
+        if self.visualize:
+            plt.show(block=True)
+        return
+
+    def run_until(self, time = None, steps = None, wall_clock = None):
+        """Take steps until reaching a simulation time, a number of steps or a number of wall clock seconds, whichever comes first; returns the number of steps taken"""
+        self.check_limits(time, steps, wall_clock)
+        start_clock = perf_counter()
+        steps_taken = 0
+        while not self.reached_limits(steps_taken, start_clock, time, steps, wall_clock):
+            self.step()
+            steps_taken += 1
+        return steps_taken
+
+    def iterate(self, every = 1, time = None, steps = None, wall_clock = None):
+        """Generator that takes steps like run_until and yields a State every so many steps (never if every is zero)"""
+        self.check_limits(time, steps, wall_clock)
+        start_clock = perf_counter()
+        steps_taken = 0
+        while not self.reached_limits(steps_taken, start_clock, time, steps, wall_clock):
+            self.step()
+            steps_taken += 1
+            if every > 0 and steps_taken % every == 0:
+                yield State(self)
+        return
+
+    def check_limits(self, time, steps, wall_clock):
+        """Make sure that run_until and iterate have something to stop at"""
+        if time is None and steps is None and wall_clock is None:
+            raise ValueError("run_until and iterate need at least one of time, steps or wall_clock")
+        return
+
+    def reached_limits(self, steps_taken, start_clock, time, steps, wall_clock):
+        """Whether any of the limits of run_until or iterate has been reached"""
+        # The time argument hides the time module, so use perf_counter directly
+        if steps is not None and steps_taken >= steps:
+            return True
+        if time is not None and self.time >= time:
+            return True
+        if wall_clock is not None and perf_counter() - start_clock >= wall_clock:
+            return True
+        return False
+
+    def state(self):
+        """Get a snapshot of the current state"""
+        return State(self)
+
+    def get_force_physics(self):
+        """Get the packages to calculate forces with, fusing the ball-ball packages if needed"""
+        key = (self.fuse_pairs,) + tuple(id(p) for p in self.physics)
+        if key != self.force_physics_key:
+            self.force_physics = fuse_physics(self.physics) if self.fuse_pairs else list(self.physics)
+            self.force_physics_key = key
+            for p in self.force_physics:
+                p.set_simulation(self)
+        return self.force_physics
+
+    def calculate_forces(self, awake = None):
+        """Get the force on each ball from all the physics, for the balls as they are now"""
+        self.workspace.gather(self.balls, awake)
+        forces = self.workspace.forces
+        forces.fill(0.0)
+        for p in self.get_force_physics():
+            physics_timer = time.perf_counter()
+            p.add_force(self.balls, forces)
+            p.physics_time += time.perf_counter() - physics_timer
+        return forces
+
+    def step(self):
+        """Take a single time step"""
+        # Start our timer
+        timer = time.perf_counter()
+
+        # Put balls that are close together next to each other in the list
+        if self.reorder_step > 0 and self.step_count > 0 and self.step_count % self.reorder_step == 0:
+            self.reorder_balls()
+
+        # Choose the time step before the physics packages use it
+        if self.time_step_controller is not None and self.integrator is None:
+            self.time_step_controller.choose_time_step(self)
+
+        # Prepare things before calculating the forces
+        self.start_allocations()
+        for p in self.physics:
+            physics_timer = time.perf_counter()
+            p.pre_step_update(self.balls, self.time_step)
+            p.physics_time += time.perf_counter() - physics_timer
+        self.stop_allocations("Pre-step")
+
+        if self.integrator is not None:
+            # Let the integrator calculate the forces and move the balls
+            self.start_allocations()
+            self.integrator.step(self)
+            self.update_kinetic_energy()
+            self.stop_allocations("Integration")
+            self.finish_step(timer)
+            return
+
+        # Only look at the balls that are awake
+        awake = self.awake_indices()
+
+        # Get the forces on each ball, unless the time step controller still has them from the end of the last step
+        self.start_allocations()
+        if self.time_step_controller is not None:
+            forces = self.time_step_controller.start_forces(self, awake)
+        else:
+            forces = self.calculate_forces(awake)
+        self.stop_allocations("Forces")
+
+        if self.sleeping is not None:
+            # Wake up and put to sleep any balls that need it, which needs the contacts found with the forces
+            woken = self.sleeping.update(self.balls)
+            awake = self.awake_indices()
+            if woken:
+                # The woken balls didn't get the environment forces or the pairs among themselves, so get the forces again
+                self.start_allocations()
+                if self.time_step_controller is not None:
+                    forces = self.time_step_controller.start_forces(self, awake)
+                else:
+                    forces = self.calculate_forces(awake)
+                self.stop_allocations("Forces")
+
+        self.start_allocations()
+        if self.time_step_controller is not None:
+            # Take the step, trying again with a smaller time step if it isn't accurate enough
+            self.time_step_controller.step(self, forces, awake)
+        else:
+            self.euler_update(forces, awake)
+
+        # Update the kinetic energy
+        self.update_kinetic_energy()
+        self.stop_allocations("Integration")
+        self.finish_step(timer)
+        return
+
+    def euler_update(self, forces, awake = None):
+        """Move the awake balls forward by one time step, given the forces on them"""
+        dv = self.workspace.array("dv", (2,))
+        for i in (range(len(self.balls)) if awake is None else awake):
+            b = self.balls[i]
+            # Calculate the change in velocity from the force
+            # F = m * a, so a = F / m, and v = v0 + dt * a
+            np.multiply(forces[i], self.time_step / b.mass, out=dv)
+            b.velocity += dv
+
+            # Increase the position
+            # x = x0 + dt * v
+            self.update_position(b)
+        return
+
+    def finish_step(self, timer):
+        """Add to the time and update the statistics at the end of a step"""
+        # Add to our time
+        self.physics_time += time.perf_counter() - timer
+
+        # Increment the time
+        self.time += self.time_step
+        self.step_count += 1
+
+        # Update the statistics that are due
+        for o in self.observers:
+            if self.step_count % o.every == 0:
+                observer_timer = time.perf_counter()
+                o.update(self)
+                o.observer_time += time.perf_counter() - observer_timer
+        return
+
+    def reorder_balls(self):
+        """Sort the balls along a Z-order curve; the Ball objects don't change, so references to them and their ids stay valid"""
+        if len(self.balls) < 2:
+            return
+        order = morton_order([b.position for b in self.balls])
+        self.balls[:] = [self.balls[k] for k in order]
+
+        # Everything that was stored by index has to be redone
+        self.workspace.balls_reordered()
+        self.index = None
+        if self.sleeping is not None:
+            self.sleeping.mask_key = None
+        for o in self.observers:
+            o.balls_reordered(order)
+        return
+
+    def ball_properties_changed(self):
+        """Make the physics packages copy the masses, charges and radii again; setting them on a ball already does this"""
+        self.workspace.properties_changed()
+        return
+
+    def set_sleeping(self, sleeping):
+        """Let balls that have stopped moving fall asleep, using a Sleeping object"""
+        sleeping.set_simulation(self)
+        self.sleeping = sleeping
+        return sleeping
+
+    def awake_indices(self):
+        """Indices of the balls that are awake, or None if they all are"""
+        if self.sleeping is None:
+            return None
+        asleep = self.sleeping.asleep_mask(self.balls)
+        if not np.any(asleep):
+            self.workspace.set_awake(None)
+            return None
+        awake = ~asleep
+        self.workspace.resize(len(self.balls))
+        self.workspace.set_awake(awake)
+        return np.nonzero(awake)[0]
+
+    def add_observer(self, observer):
+        """Add something that gathers statistics every observer.every steps"""
+        observer.attach(self)
+        self.observers.append(observer)
+        return observer
+
+    def positions_changed(self):
+        """Call this after moving balls in the middle of a step, so the spatial index is made again the next time it is asked for"""
+        self.position_version += 1
         return
 
     def update_position(self, ball):
-        dx = ball.velocity * self.time_step
+        self.positions_changed()
+        dx = self.workspace.array("dx", (2,))
+        np.multiply(ball.velocity, self.time_step, out=dx)
 
         if self.box is not None:
             timer = time.perf_counter()
             # Make sure to take box collisions into account!
-            ball.position, direction = self.box.update_position(ball.position, dx, ball.radius)
-            ball.velocity = direction * np.linalg.norm(ball.velocity)
+            speed = np.sqrt(ball.velocity[0] * ball.velocity[0] + ball.velocity[1] * ball.velocity[1])
+            ball.position, direction = self.box.update_position(ball.position, dx, ball.radius, ball.mass * speed)
+            np.multiply(direction, speed, out=ball.velocity)
             self.boundary_time += time.perf_counter() - timer
             return
         
@@ -124,6 +395,42 @@ class Simulation:
         ball.position += dx
         return
 
+    def start_allocations(self):
+        """Start measuring the memory allocated in a part of the step"""
+        if self.track_allocations:
+            tracemalloc.reset_peak()
+            self.allocation_start = tracemalloc.get_traced_memory()[0]
+        return
+
+    def stop_allocations(self, phase):
+        """Add the peak and retained memory for a part of the step to the totals"""
+        if self.track_allocations:
+            current, peak = tracemalloc.get_traced_memory()
+            totals = self.allocations.setdefault(phase, [0, 0, 0])
+            totals[0] += 1
+            totals[1] += peak - self.allocation_start
+            totals[2] += current - self.allocation_start
+        return
+
+    def spatial_index(self):
+        """Get a k-d tree of the current ball positions; indices in the tree are indices into the balls list"""
+        key = (self.step_count, self.position_version, len(self.balls))
+        if self.index is not None and key == self.index_key:
+            # Nothing has moved since the last time we were asked
+            return self.index
+        
+        positions = [b.position for b in self.balls]
+        if self.index is not None and self.index_key[2] == len(self.balls) and self.index_refits < self.index_rebuild_step:
+            # Same balls, so just update the bounding boxes
+            self.index.refit(positions)
+            self.index_refits += 1
+        else:
+            # Rebuild every so often so the tree doesn't get too unbalanced
+            self.index = KDTree(positions)
+            self.index_refits = 0
+        self.index_key = key
+        return self.index
+
     def update_kinetic_energy(self):
         self.kinetic_energy = 0.0
         for b in self.balls:
@@ -136,6 +443,8 @@ class Simulation:
         return [np.amin(pos)- radius, np.amax(pos)+ radius]
     
     def initialize_visualization(self, reinitialize = False):
+        if not self.visualize:
+            return
         timer = time.perf_counter()
         
         if reinitialize:
@@ -144,9 +453,12 @@ class Simulation:
             plt.style.use('dark_background')
             self.fig, self.ax = plt.subplots(dpi=150)
             plt.show(block=False)
-        self.patches = [plt.Circle(b.position, b.radius, color=b.color) for b in self.balls]
+        self.patch_balls = list(self.balls)
+        self.patches = [plt.Circle(b.position, b.radius, color=b.color) for b in self.patch_balls]
         self.collection = mc.PatchCollection(self.patches, match_original=True)
         self.ax.add_collection(self.collection)
+        if self.box is not None:
+            self.ax.add_collection(mc.LineCollection(self.box.lines(), colors="w", linewidths=0.5))
         self.set_limits(True)
         
         self.visualization_time += time.perf_counter() - timer
@@ -154,9 +466,11 @@ class Simulation:
         return
     
     def update_visualization(self):
+        if not self.visualize:
+            return
         timer = time.perf_counter()
 
-        for b, c in zip(self.balls, self.patches):
+        for b, c in zip(self.patch_balls, self.patches):
             c.center = b.position
         self.collection.set_paths(self.patches)
         self.set_limits()
@@ -210,9 +524,25 @@ class Simulation:
         print(" ----------------------------- ")
         print("Physics: ", self.physics_time)
         for p in self.physics:
-            print("    {}: ".format(p.__class__.__name__), p.physics_time)
+            print("    {}: ".format(p.name()), p.physics_time)
+        if self.force_physics is not None:
+            for p in self.force_physics:
+                if not any(p is q for q in self.physics):
+                    print("    {}: ".format(p.name()), p.physics_time)
         print("    Boundary: ", self.boundary_time)
         print("Visualization: ", self.visualization_time)
+        if self.observers:
+            print("Observers: ", sum(o.observer_time for o in self.observers))
+            for o in self.observers:
+                print("    {}: ".format(o.name()), o.observer_time)
+        if self.allocations:
+            print()
+            print(" ----------------------------- ")
+            print("   Allocations (bytes/step)    ")
+            print(" ----------------------------- ")
+            print("{:>12} {:>11} {:>11}".format("", "peak", "retained"))
+            for phase, (steps, peak, retained) in self.allocations.items():
+                print("{:>12} {:11.1f} {:11.1f}".format(phase, peak / steps, retained / steps))
         return
     
     def print_unicorn(self):
@@ -0,0 +1,193 @@
+import numpy as np
+import operator
+
+from Physics import Collision
+
+class Sleeping:
+    """Freezes groups of touching balls that have stopped moving, and wakes them up when an awake ball touches them"""
+
+    def __init__(self,
+                 velocity_threshold = 0.01,
+                 acceleration_threshold = 1.0,
+                 wake_threshold = 0.05,
+                 num_steps = 50,
+                 smoothing = 0.1):
+        # A ball is quiet if its average speed stays below the velocity threshold, and it can fall asleep if its
+        # average velocity has changed by less than the acceleration threshold times the time it has been quiet.
+        # The net force can't be used for this, since a ball resting on the floor of a box still feels gravity.
+        self.velocity_threshold = velocity_threshold
+        self.acceleration_threshold = acceleration_threshold
+
+        # An island only wakes up when a ball touching it moves faster than this, which is bigger than the velocity
+        # threshold so that a pile that is still settling doesn't keep waking itself up
+        self.wake_threshold = wake_threshold
+
+        # Fraction of the new velocity that goes into the average each step
+        self.smoothing = smoothing
+        self.last_time = 0.0
+
+        # Number of steps a ball has to be quiet before it can fall asleep
+        self.num_steps = num_steps
+
+        # Balls in each sleeping island, so the whole island can be woken up at once
+        self.islands = {}
+        self.next_island = 0
+
+        # What is kept for each ball, one row per ball in the order of the balls list; rows finds the row of a ball
+        self.balls = []
+        self.rows = {}
+        self.sleep_counter = np.zeros(0, dtype=int)
+        self.average_velocity = np.zeros((0, 2))
+        self.last_position = np.zeros((0, 2))
+        self.moved_before = np.zeros(0, dtype=bool)
+        self.sleep_velocity = np.zeros((0, 2))
+        self.sleep_time = np.zeros(0)
+        self.island = np.zeros(0, dtype=int)
+
+        # Changes every time a ball falls asleep or wakes up
+        self.version = 0
+        self.mask_key = None
+        return
+
+    def asleep_mask(self, balls):
+        """Boolean array of which balls are asleep, only remade if something has changed"""
+        key = (self.version, len(balls))
+        if key != self.mask_key:
+            self.mask = np.array([b.asleep for b in balls], dtype=bool)
+            self.mask_key = key
+        return self.mask
+
+    def set_simulation(self, simulation):
+        """Find the collision packages and ask them to keep track of which balls are touching"""
+        self.simulation = simulation
+        self.collisions = [p for p in simulation.physics if isinstance(p, Collision)]
+        for p in self.collisions:
+            p.record_contacts = True
+        return
+
+    def match_balls(self, balls):
+        """Move the rows around to match the balls list, if balls have been added, removed or reordered"""
+        if len(balls) == len(self.balls) and not any(map(operator.is_not, balls, self.balls)):
+            return
+        old = [self.rows.get(id(b), -1) for b in balls]
+        new = [k for k in range(len(balls)) if old[k] >= 0]
+        old = [old[k] for k in new]
+        for name, empty in [("sleep_counter", 0), ("average_velocity", 0.0), ("last_position", 0.0), ("moved_before", False),
+                            ("sleep_velocity", 0.0), ("sleep_time", 0.0), ("island", -1)]:
+            values = getattr(self, name)
+            rows = np.full((len(balls),) + values.shape[1:], empty, dtype=values.dtype)
+            rows[new] = values[old]
+            setattr(self, name, rows)
+        self.balls = list(balls)
+        self.rows = {id(b): k for k, b in enumerate(balls)}
+        return
+
+    def contacts(self):
+        """Pairs of balls that are touching, from all the collision packages"""
+        found = [p.contacts for p in self.collisions if p.contacts is not None]
+        if not found:
+            return np.array([], dtype=int), np.array([], dtype=int)
+        return np.concatenate([f[0] for f in found]), np.concatenate([f[1] for f in found])
+
+    def wake(self, ball):
+        """Wake up a ball and the rest of its island"""
+        for b in self.islands.pop(self.island[self.rows[id(ball)]], [ball]):
+            k = self.rows.get(id(b))
+            b.asleep = False
+            if k is not None:
+                self.sleep_counter[k] = 0
+                self.island[k] = -1
+        self.version += 1
+        return
+
+    def update(self, balls):
+        """Wake up islands that a moving ball has touched and put groups of touching balls that have been quiet for long enough to sleep; returns whether any ball woke up"""
+        self.match_balls(balls)
+        num_balls = len(balls)
+        asleep = self.asleep_mask(balls)
+        contact_i, contact_j = self.contacts()
+
+        # Average the velocity of each awake ball over the last few steps, from how far it has moved, since
+        # the velocity of a ball resting on the floor of a box jumps up every time it bounces off the floor
+        time = self.simulation.time
+        awake = np.nonzero(~asleep)[0]
+        positions = np.array([balls[i].position for i in awake], dtype=float).reshape(-1, 2)
+        if time > self.last_time:
+            moved = awake[self.moved_before[awake]]
+            velocity = (positions[self.moved_before[awake]] - self.last_position[moved]) / (time - self.last_time)
+            self.average_velocity[moved] += self.smoothing * (velocity - self.average_velocity[moved])
+        self.last_position[awake] = positions
+        self.moved_before[awake] = True
+        self.last_time = time
+        average = self.average_velocity.copy()
+        average[asleep] = 0.0
+        speed2 = np.einsum('bd,bd->b', average, average)
+        moving = ~asleep & (speed2 >= self.velocity_threshold ** 2)
+        fast = ~asleep & (speed2 >= self.wake_threshold ** 2)
+
+        # Wake up any island that a fast ball is touching
+        touched = (asleep[contact_i] & fast[contact_j]) | (fast[contact_i] & asleep[contact_j])
+        woken = False
+        for i, j in zip(contact_i[touched], contact_j[touched]):
+            sleeper = balls[i] if asleep[i] else balls[j]
+            if sleeper.asleep:
+                self.wake(sleeper)
+                woken = True
+        if woken:
+            # Woken balls can't fall back asleep this step
+            return True
+
+        # Count how long each awake ball has been quiet
+        if len(awake) == 0:
+            return False
+        counter = self.sleep_counter
+        counter[moving] = 0
+        quiet = ~asleep & ~moving
+        starting = quiet & (counter == 0)
+        self.sleep_velocity[starting] = self.average_velocity[starting]
+        self.sleep_time[starting] = time
+        counter[quiet] += 1
+
+        # Balls that are slowly speeding up, like at the top of a bounce, start over
+        long_enough = quiet & (counter >= self.num_steps)
+        change = self.average_velocity - self.sleep_velocity
+        steady = np.einsum('bd,bd->b', change, change) <= (self.acceleration_threshold * (time - self.sleep_time)) ** 2
+        ready = long_enough & steady
+        counter[long_enough & ~steady] = 0
+        if not np.any(ready):
+            return False
+
+        # Group touching balls that are ready or already asleep into islands by passing the smallest index along each contact
+        joined = (ready | asleep)[contact_i] & (ready | asleep)[contact_j]
+        contact_i = contact_i[joined]
+        contact_j = contact_j[joined]
+        labels = np.arange(num_balls)
+        changed = len(contact_i) > 0
+        while changed:
+            old = labels.copy()
+            smallest = np.minimum(labels[contact_i], labels[contact_j])
+            np.minimum.at(labels, contact_i, smallest)
+            np.minimum.at(labels, contact_j, smallest)
+            labels = labels[labels]
+            changed = not np.array_equal(old, labels)
+
+        # Put each group with a ready ball to sleep
+        for label in np.unique(labels[ready]):
+            island = self.next_island
+            self.next_island += 1
+            members = [balls[i] for i in np.nonzero(labels == label)[0]]
+            for b in list(members):
+                old_island = self.island[self.rows[id(b)]]
+                if b.asleep and old_island in self.islands:
+                    # Merge the old island into the new one
+                    members += [m for m in self.islands.pop(old_island) if m is not b]
+            for b in members:
+                k = self.rows.get(id(b))
+                b.asleep = True
+                b.velocity[:] = 0.0
+                if k is not None:
+                    self.island[k] = island
+                    self.average_velocity[k] = 0.0
+            self.islands[island] = members
+        self.version += 1
+        return False
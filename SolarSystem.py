@@ -1,4 +1,5 @@
 from Ball import Ball
+from Integrator import WisdomHolman
 from Physics import Gravity
 from Simulation import Simulation
 
@@ -8,6 +9,9 @@ import numpy as np
 include_moon = False
 normalize_radii = True
 
+# Move the planets along their Kepler orbits around the sun, which stays accurate with bigger time steps
+use_wisdom_holman = False
+
 # Convenience function
 def find_index(search, descriptions):
     for i, d in enumerate(descriptions):
@@ -64,6 +68,11 @@ simulation = Simulation(balls, physics, limits=limits)
 one_day = 24.0 * 3600.0
 simulation.time_step = one_day if include_moon else 10.0 * one_day
 
+# The Wisdom-Holman integrator can take steps four times bigger with better accuracy
+if use_wisdom_holman:
+    simulation.integrator = WisdomHolman([b for b in balls if b.name == "sun"][0])
+    simulation.time_step *= 4
+
 # Set number of time steps such that end time is equal to four earth years or one Pluto year
 num_years = 4 if include_moon else 248
 simulation.num_time_steps = int(num_years * 365.0 * one_day / simulation.time_step)
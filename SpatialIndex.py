@@ -0,0 +1,208 @@
+import heapq
+import numpy as np
+
+def morton_order(positions, bits = 16):
+    """Order of the positions along a Z-order (Morton) curve, so points that are close in space are mostly close in the order"""
+    # https://en.wikipedia.org/wiki/Z-order_curve
+    positions = np.array(positions, dtype=float).reshape(-1, 2)
+    low = np.amin(positions, axis=0)
+    size = np.amax(positions, axis=0) - low
+    size[size == 0.0] = 1.0
+
+    # Put each point in a cell of a 2^bits by 2^bits grid, then interleave the bits of the cell indices
+    cells = ((positions - low) / size * (2 ** bits - 1)).astype(np.uint64)
+    codes = np.zeros(len(positions), dtype=np.uint64)
+    for b in range(bits):
+        for d in range(2):
+            codes |= ((cells[:, d] >> np.uint64(b)) & np.uint64(1)) << np.uint64(2 * b + d)
+    return np.argsort(codes, kind='stable')
+
+class KDTree:
+    """A k-d tree over a set of points for radius, nearest neighbor and pair queries"""
+
+    def __init__(self,
+                 positions,
+                 leaf_size = 8):
+        # Maximum number of points in a node before it gets split
+        self.leaf_size = leaf_size
+
+        # Build the tree
+        self.build(positions)
+        return
+
+    def build(self, positions):
+        """Build the tree from scratch"""
+        self.positions = np.array(positions, dtype=float).reshape(-1, 2)
+        self.num_points = len(self.positions)
+
+        # The points in each node are order[start:end]
+        self.order = np.arange(self.num_points)
+
+        # Each node has a start, end, two children (-1 for leaves) and a bounding box
+        self.start = []
+        self.end = []
+        self.left = []
+        self.right = []
+        if self.num_points > 0:
+            self.build_node(0, self.num_points)
+        self.start = np.array(self.start, dtype=int)
+        self.end = np.array(self.end, dtype=int)
+        self.left = np.array(self.left, dtype=int)
+        self.right = np.array(self.right, dtype=int)
+        self.lower = np.zeros((len(self.start), 2))
+        self.upper = np.zeros((len(self.start), 2))
+        self.fit_boxes()
+        return
+
+    def build_node(self, start, end):
+        """Make a node for order[start:end] and split it if it has too many points"""
+        node = len(self.start)
+        self.start.append(start)
+        self.end.append(end)
+        self.left.append(-1)
+        self.right.append(-1)
+        if end - start <= self.leaf_size:
+            return node
+
+        # Split at the median along the widest direction
+        points = self.positions[self.order[start:end]]
+        d = np.argmax(np.ptp(points, axis=0))
+        middle = (end - start) // 2
+        split = np.argpartition(points[:, d], middle)
+        self.order[start:end] = self.order[start:end][split]
+        self.left[node] = self.build_node(start, start + middle)
+        self.right[node] = self.build_node(start + middle, end)
+        return node
+
+    def fit_boxes(self):
+        """Calculate the bounding box of each node from its points"""
+        # Children are always made after their parents, so go backwards
+        for node in range(len(self.start) - 1, -1, -1):
+            left = self.left[node]
+            if left < 0:
+                points = self.positions[self.order[self.start[node]:self.end[node]]]
+                self.lower[node] = np.amin(points, axis=0)
+                self.upper[node] = np.amax(points, axis=0)
+            else:
+                right = self.right[node]
+                self.lower[node] = np.minimum(self.lower[left], self.lower[right])
+                self.upper[node] = np.maximum(self.upper[left], self.upper[right])
+        return
+
+    def refit(self, positions):
+        """Keep the structure of the tree, but update the bounding boxes for points that have moved"""
+        positions = np.array(positions, dtype=float).reshape(-1, 2)
+        if len(positions) != self.num_points:
+            raise ValueError("refit needs the same number of points as the tree was built with")
+        self.positions = positions
+        self.fit_boxes()
+        return
+
+    def box_distance2(self, node, point):
+        """Squared distance from a point to the bounding box of a node"""
+        gap = np.maximum(self.lower[node] - point, 0.0) + np.maximum(point - self.upper[node], 0.0)
+        return np.dot(gap, gap)
+
+    def query_radius(self, point, radius):
+        """Get the indices of all the points within the radius of the point"""
+        point = np.asarray(point, dtype=float)
+        radius2 = radius * radius
+        found = []
+        if self.num_points == 0:
+            return np.array(found, dtype=int)
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if self.box_distance2(node, point) > radius2:
+                continue
+            if self.left[node] < 0:
+                indices = self.order[self.start[node]:self.end[node]]
+                r = self.positions[indices] - point
+                found.append(indices[np.einsum('pd,pd->p', r, r) <= radius2])
+            else:
+                stack.append(self.left[node])
+                stack.append(self.right[node])
+        if not found:
+            return np.array(found, dtype=int)
+        return np.concatenate(found)
+
+    def query_nearest(self, point, k = 1):
+        """Get the indices and distances of the k nearest points to the point, closest first"""
+        point = np.asarray(point, dtype=float)
+        k = min(k, self.num_points)
+
+        # Keep the best k points as a heap of (-distance^2, index)
+        best = []
+        if k == 0:
+            return np.array([], dtype=int), np.array([])
+        nodes = [(0.0, 0)]
+        while nodes:
+            node_dist2, node = heapq.heappop(nodes)
+            if len(best) == k and node_dist2 > -best[0][0]:
+                # Nodes come out closest first, so nothing else can be closer
+                break
+            if self.left[node] < 0:
+                indices = self.order[self.start[node]:self.end[node]]
+                r = self.positions[indices] - point
+                for index, dist2 in zip(indices, np.einsum('pd,pd->p', r, r)):
+                    if len(best) < k:
+                        heapq.heappush(best, (-dist2, index))
+                    elif dist2 < -best[0][0]:
+                        heapq.heapreplace(best, (-dist2, index))
+            else:
+                for child in [self.left[node], self.right[node]]:
+                    heapq.heappush(nodes, (self.box_distance2(child, point), child))
+        best = sorted(best, reverse=True)
+        indices = np.array([b[1] for b in best], dtype=int)
+        distances = np.sqrt([-b[0] for b in best])
+        return indices, distances
+
+    def node_distance2(self, nodea, nodeb):
+        """Squared distance between the bounding boxes of two nodes"""
+        gap = np.maximum(self.lower[nodea] - self.upper[nodeb], 0.0) + np.maximum(self.lower[nodeb] - self.upper[nodea], 0.0)
+        return np.dot(gap, gap)
+
+    def query_pairs(self, radius):
+        """Get all the pairs of point indices (i, j) with i < j that are within the radius of each other"""
+        radius2 = radius * radius
+        found_i = []
+        found_j = []
+        if self.num_points == 0:
+            return np.array([], dtype=int), np.array([], dtype=int)
+        stack = [(0, 0)]
+        while stack:
+            nodea, nodeb = stack.pop()
+            if self.node_distance2(nodea, nodeb) > radius2:
+                continue
+            lefta = self.left[nodea] < 0
+            leftb = self.left[nodeb] < 0
+            if lefta and leftb:
+                # Compare all the points in the two leaves
+                indicesa = self.order[self.start[nodea]:self.end[nodea]]
+                indicesb = self.order[self.start[nodeb]:self.end[nodeb]]
+                r = self.positions[indicesa][:, np.newaxis, :] - self.positions[indicesb][np.newaxis, :, :]
+                close = np.einsum('abd,abd->ab', r, r) <= radius2
+                if nodea == nodeb:
+                    # Don't count pairs twice within the same leaf
+                    close = np.triu(close, 1)
+                a, b = np.nonzero(close)
+                found_i.append(indicesa[a])
+                found_j.append(indicesb[b])
+            elif nodea == nodeb:
+                left = self.left[nodea]
+                right = self.right[nodea]
+                stack.append((left, left))
+                stack.append((right, right))
+                stack.append((left, right))
+            elif lefta or (not leftb and self.end[nodeb] - self.start[nodeb] > self.end[nodea] - self.start[nodea]):
+                # Split the bigger node
+                stack.append((nodea, self.left[nodeb]))
+                stack.append((nodea, self.right[nodeb]))
+            else:
+                stack.append((self.left[nodea], nodeb))
+                stack.append((self.right[nodea], nodeb))
+        if not found_i:
+            return np.array([], dtype=int), np.array([], dtype=int)
+        i = np.concatenate(found_i)
+        j = np.concatenate(found_j)
+        return np.minimum(i, j), np.maximum(i, j)
@@ -0,0 +1,150 @@
+from Ball import Ball
+
+import numpy as np
+import operator
+
+class Workspace:
+    """Arrays that are reused from step to step, so the step loop doesn't need to allocate memory"""
+
+    def __init__(self, dimension = 2):
+        self.dimension = dimension
+        self.num_balls = -1
+        self.balls = None
+        self.awake = None
+        self.awake_indices = None
+        self.arrays = {}
+
+        # Balls whose masses, charges and radii are in the arrays, in their order then, and the Ball.properties_version when they were copied
+        self.property_balls = None
+        self.property_order = []
+        self.properties_version = -1
+
+        # Changes whenever the masses, charges, radii or pairs change, so physics packages can keep what they calculate from them
+        self.version = 0
+        return
+
+    def array(self, name, shape, dtype = float):
+        """Get a named array, only allocating it the first time or if the shape has changed"""
+        a = self.arrays.get(name)
+        if a is None or a.shape != shape or a.dtype != dtype:
+            a = np.zeros(shape, dtype=dtype)
+            self.arrays[name] = a
+        return a
+
+    def resize(self, num_balls):
+        """Allocate the per-ball and per-pair arrays if the number of balls has changed"""
+        if num_balls == self.num_balls:
+            return
+        self.num_balls = num_balls
+        d = self.dimension
+
+        # The new arrays are empty, so the next gather has to copy every ball
+        self.balls = None
+        self.property_balls = None
+
+        # Per-ball arrays
+        self.forces = self.array("forces", (num_balls, d))
+        self.positions = self.array("positions", (num_balls, d))
+        self.velocities = self.array("velocities", (num_balls, d))
+        self.masses = self.array("masses", (num_balls,))
+        self.charges = self.array("charges", (num_balls,))
+        self.radii = self.array("radii", (num_balls,))
+
+        # Per-pair arrays, with i < j for each pair
+        self.all_pair_i, self.all_pair_j = np.triu_indices(num_balls, 1)
+        self.awake = None
+        self.awake_indices = None
+        self.set_pairs(self.all_pair_i, self.all_pair_j)
+        return
+
+    def set_pairs(self, pair_i, pair_j):
+        """Choose which pairs the pair kernels work on"""
+        num_pairs = len(pair_i)
+        self.pair_i = pair_i
+        self.pair_j = pair_j
+        self.separations = self.array("separations", (num_pairs, self.dimension))
+        self.r2 = self.array("r2", (num_pairs,))
+        self.dist = self.array("dist", (num_pairs,))
+        self.coeff = self.array("coeff", (num_pairs,))
+        self.version += 1
+        return
+
+    def set_awake(self, awake):
+        """Only keep the pairs that have at least one awake ball, given a boolean array or None for all balls awake; awake_indices lists the awake balls"""
+        if awake is None and self.awake is None:
+            return
+        if awake is not None and self.awake is not None and np.array_equal(awake, self.awake):
+            return
+        if awake is None:
+            self.awake = None
+            self.awake_indices = None
+            self.set_pairs(self.all_pair_i, self.all_pair_j)
+            return
+        self.awake = awake.copy()
+        self.awake_indices = np.nonzero(awake)[0]
+        keep = awake[self.all_pair_i] | awake[self.all_pair_j]
+        self.set_pairs(self.all_pair_i[keep], self.all_pair_j[keep])
+        return
+
+    def balls_reordered(self):
+        """Say that the balls have changed places in the list, so the next gather copies all of them"""
+        self.balls = None
+        self.property_balls = None
+        return
+
+    def properties_changed(self):
+        """Make the next gather copy the masses, charges and radii again, even if no ball says it has changed"""
+        self.property_balls = None
+        return
+
+    def gather_properties(self, balls):
+        """Copy the masses, charges and radii of the balls, only if they are different balls, in a different order or one of them has been changed"""
+        if (balls is self.property_balls and len(balls) == self.num_balls and Ball.properties_version == self.properties_version
+            and not any(map(operator.is_not, balls, self.property_order))):
+            return
+        self.resize(len(balls))
+        for k, b in enumerate(balls):
+            self.masses[k] = b.mass
+            self.charges[k] = b.charge
+            self.radii[k] = b.radius
+        self.property_balls = balls
+        self.property_order = list(balls)
+
+        # The balls may have changed places too, so the positions and velocities all need copying
+        self.balls = None
+        self.properties_version = Ball.properties_version
+        self.version += 1
+        return
+
+    def gather(self, balls, indices = None):
+        """Copy the state of the balls into the per-ball arrays; if indices are given and the balls are the same as last time, only copy those balls"""
+        self.gather_properties(balls)
+        if indices is None or balls is not self.balls:
+            indices = range(len(balls))
+        self.balls = balls
+        for k in indices:
+            b = balls[k]
+            self.positions[k] = b.position
+            self.velocities[k] = b.velocity
+        return
+
+    def update_separations(self):
+        """Calculate r = x_i - x_j, r^2 and the distance for each pair"""
+        r = self.separations
+        scratch = self.array("separation_scratch", r.shape)
+        np.take(self.positions, self.pair_i, axis=0, out=r, mode='clip')
+        np.take(self.positions, self.pair_j, axis=0, out=scratch, mode='clip')
+        np.subtract(r, scratch, out=r)
+        np.einsum('pd,pd->p', r, r, out=self.r2)
+        np.sqrt(self.r2, out=self.dist)
+        return
+
+    def add_pair_forces(self, forces):
+        """Add the force c * r on ball i and -c * r on ball j for each pair, with c from self.coeff"""
+        force = self.array("pair_force", (len(self.coeff),))
+        for d in range(self.dimension):
+            # Sum the forces of the pairs on each ball, so the work only grows with the number of pairs
+            np.multiply(self.coeff, self.separations[:, d], out=force)
+            forces[:self.num_balls, d] += np.bincount(self.pair_i, weights=force, minlength=self.num_balls)
+            forces[:self.num_balls, d] -= np.bincount(self.pair_j, weights=force, minlength=self.num_balls)
+        return